@@ -0,0 +1,139 @@
+"""Measure WebSocket latency while a storm of password logins hits the app.
+
+Starts the app on a local port, keeps a WebSocket open and pings it every few
+milliseconds, first with no other load and then while concurrent clients log in
+through /token. Each login runs a bcrypt check, which used to block the event
+loop; --inline runs bcrypt on the loop again for comparison. Usage:
+
+    python benchmarks/login_storm.py [--logins 64] [--concurrency 16] [--inline]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-benchmark-secret-key")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+import httpx
+import uvicorn
+import websockets
+
+import main
+from utils import security
+
+PASSWORD = "benchmark-password"
+PING_INTERVAL = 0.01
+
+
+def run_inline():
+    """Put bcrypt back on the event loop, as before the thread pool"""
+    async def inline(func, *args):
+        return func(*args)
+    security.password_hasher._run = inline
+
+
+async def sample_latency(ws, stop: asyncio.Event) -> list:
+    """Ping round trips in milliseconds until stop is set or the server drops the socket"""
+    samples = []
+    try:
+        while not stop.is_set():
+            started = time.perf_counter()
+            await (await ws.ping())
+            samples.append((time.perf_counter() - started) * 1000)
+            await asyncio.sleep(PING_INTERVAL)
+    except websockets.ConnectionClosed as e:
+        print(f"WebSocket closed by the server after {len(samples)} pings: {e}")
+    return samples
+
+
+async def storm(base_url: str, users: int, logins: int, concurrency: int):
+    """Return (seconds taken, failed logins)"""
+    remaining = iter(range(logins))
+    failed = 0
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal failed
+        for number in remaining:
+            try:
+                response = await client.post("/token", json={"username": f"user{number % users}", "password": PASSWORD})
+                response.raise_for_status()
+            except httpx.HTTPError:
+                failed += 1
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return time.perf_counter() - started, failed
+
+
+def summary(label: str, samples: list):
+    if len(samples) < 2:
+        print(f"{label:<16}{len(samples):>8}")
+        return
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    print(
+        f"{label:<16}{len(samples):>8}{statistics.median(samples):>9.2f}"
+        f"{quantiles[94]:>9.2f}{quantiles[98]:>9.2f}{samples[-1]:>9.2f}"
+    )
+
+
+async def benchmark(logins: int, concurrency: int, port: int, inline: bool):
+    server = uvicorn.Server(uvicorn.Config(main.app, port=port, log_level="warning"))
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    # Every user shares one hash so setup does not pay for a bcrypt round per user
+    users = max(1, concurrency)
+    hashed = security.get_password_hash(PASSWORD)
+    for number in range(users + 1):
+        await main.db.execute(
+            "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+            (f"user{number}", f"user{number}@example.com", hashed),
+        )
+
+    base_url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        response = await client.post("/token", json={"username": f"user{users}", "password": PASSWORD})
+        token = response.json()["access_token"]
+
+    print(f"{'ping RTT (ms)':<16}{'samples':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws?token={token}") as ws:
+        stop = asyncio.Event()
+        idle = asyncio.create_task(sample_latency(ws, stop))
+        await asyncio.sleep(1)
+        stop.set()
+        summary("idle", await idle)
+
+        stop = asyncio.Event()
+        busy = asyncio.create_task(sample_latency(ws, stop))
+        elapsed, failed = await storm(base_url, users, logins, concurrency)
+        stop.set()
+        summary("login storm", await busy)
+
+    print(f"\n{logins} logins from {concurrency} clients in {elapsed:.2f} s ({logins / elapsed:.1f} logins/s, {failed} failed)")
+    if not inline:
+        print(f"password hasher: {security.password_hasher.stats()}")
+
+    server.should_exit = True
+    await serve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--inline", action="store_true", help="run bcrypt on the event loop (the old behaviour)")
+    args = parser.parse_args()
+    if args.inline:
+        run_inline()
+    asyncio.run(benchmark(args.logins, args.concurrency, args.port, args.inline))
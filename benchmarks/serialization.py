@@ -0,0 +1,98 @@
+"""Measure the cost of encoding each WebSocket frame type with every available backend.
+
+Also compares encoding a broadcast once against re-encoding it per recipient, which
+is what fan-out used to do. Usage:
+
+    python benchmarks/serialization.py [--iterations 20000] [--recipients 50]
+"""
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import serialization
+
+NOW = datetime.now().isoformat()
+
+FRAMES = {
+    "message": {
+        "type": "message",
+        "sender_id": 1,
+        "sender_username": "alice",
+        "recipient_id": 2,
+        "recipient_username": "bob",
+        "message_text": "Hey, are we still on for lunch tomorrow? I can book a table for noon.",
+        "timestamp": NOW,
+        "message_id": 123456,
+        "conversation_id": "conv_1_2",
+    },
+    "notification_update": {
+        "type": "notification_update",
+        "notification_type": "new_message",
+        "sender_username": "alice",
+        "sender_id": 1,
+        "recipient_id": 2,
+        "conversation_id": "conv_1_2",
+        "message_preview": "Hey, are we still on for lunch tomorrow? I can bo...",
+        "timestamp": NOW,
+    },
+    "typing_indicator": {"type": "typing_indicator", "username": "alice", "is_typing": True, "timestamp": NOW},
+    "read_receipt": {"type": "read_receipt", "message_id": 123456, "read_by": "bob", "timestamp": NOW},
+    "user_status_batch": {
+        "type": "user_status_batch",
+        "updates": [
+            {"user_id": user_id, "username": f"user{user_id}", "status": "online", "timestamp": NOW}
+            for user_id in range(10)
+        ],
+    },
+}
+
+
+def backends() -> dict:
+    available = {"json": serialization._json_encode}
+    if serialization.orjson is not None:
+        available["orjson"] = serialization._orjson_encode
+    if serialization.msgpack is not None:
+        available["msgpack"] = serialization.encode_binary
+    return available
+
+
+def encoded_size(encode, payload) -> int:
+    data = encode(payload)
+    return len(data.encode() if isinstance(data, str) else data)
+
+
+def per_frame_us(encode, payload, iterations: int) -> float:
+    return timeit.timeit(lambda: encode(payload), number=iterations) / iterations * 1e6
+
+
+def main(iterations: int, recipients: int):
+    available = backends()
+    print(f"Active JSON backend: {serialization.BACKEND}")
+    print(f"{'frame':<22}" + "".join(f"{name + ' (us)':>14}{'bytes':>7}" for name in available))
+    for frame_type, payload in FRAMES.items():
+        columns = "".join(
+            f"{per_frame_us(encode, payload, iterations):>14.2f}{encoded_size(encode, payload):>7}"
+            for encode in available.values()
+        )
+        print(f"{frame_type:<22}{columns}")
+
+    payload = FRAMES["message"]
+    rounds = max(1, iterations // recipients)
+    print(f"\nBroadcast of a message frame to {recipients} recipients:")
+    for name, encode in available.items():
+        per_recipient = timeit.timeit(lambda: [encode(payload) for _ in range(recipients)], number=rounds) / rounds
+        once = timeit.timeit(lambda: [encode(payload)] * recipients, number=rounds) / rounds
+        print(f"  {name}: encode per recipient {per_recipient * 1e6:,.1f} us, encode once {once * 1e6:,.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--recipients", type=int, default=50)
+    args = parser.parse_args()
+    main(args.iterations, args.recipients)
@@ -0,0 +1,65 @@
+"""Measure static-file requests per second through the full app middleware stack.
+
+Runs in process over httpx's ASGI transport so the numbers reflect the app's own
+per-request overhead rather than the network. Usage:
+
+    python benchmarks/static_files.py [--requests 2000] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-benchmark-secret-key")
+os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+import httpx
+import jwt
+
+import main
+
+
+async def run(path: str, cookies: dict, requests: int, concurrency: int) -> float:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies=cookies) as client:
+        remaining = iter(range(requests))
+
+        async def worker():
+            for _ in remaining:
+                response = await client.get(path)
+                response.raise_for_status()
+
+        await client.get(path)  # warm up
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return requests / (time.perf_counter() - started)
+
+
+async def benchmark(requests: int, concurrency: int):
+    async with main.app.router.lifespan_context(main.app):
+        await main.db.execute(
+            "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+            ("bench", "bench@example.com", "not-a-hash"),
+        )
+        token = jwt.encode(
+            {"sub": "bench", "exp": datetime.utcnow() + timedelta(minutes=30)},
+            os.environ["SECRET_KEY"],
+            algorithm="HS256",
+        )
+        for label, cookies in (("anonymous", {}), ("with auth cookie", {"auth_token": token})):
+            rps = await run("/static/css/main.css", cookies, requests, concurrency)
+            print(f"static file, {label}: {rps:,.0f} requests/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.requests, args.concurrency))
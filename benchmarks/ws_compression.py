@@ -0,0 +1,135 @@
+"""Measure the CPU cost and bandwidth saving of permessage-deflate settings on a realistic /ws frame mix.
+
+Replays a seeded stream of chat frames (messages, typing indicators, acks, read
+receipts, presence updates) through the same extension the server negotiates, as one
+client connection would receive them. Usage:
+
+    python benchmarks/ws_compression.py [--frames 20000] [--seed 7]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from websockets.frames import Frame, Opcode
+
+from utils.compression import ThresholdPerMessageDeflate, WS_COMPRESSION_WINDOW_BITS
+from utils.serialization import encode
+
+WORDS = (
+    "hey hi hello ok sure thanks lol yes no maybe tomorrow tonight lunch dinner coffee meeting "
+    "project deploy review branch merge test build release bug fix ticket call later soon "
+    "great awesome sounds good see you there on my way running late did you get the file"
+).split()
+
+USERS = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+
+# (frame type, share of traffic)
+MIX = [
+    ("message", 0.35),
+    ("typing_indicator", 0.30),
+    ("message_sent", 0.15),
+    ("read_receipt", 0.10),
+    ("user_status_update", 0.10),
+]
+
+# (label, compression enabled, level, min size, context takeover)
+CONFIGS = [
+    ("off", False, 0, 0, True),
+    ("level 1, all frames", True, 1, 0, True),
+    ("level 6, all frames", True, 6, 0, True),
+    ("level 6, >= 128 bytes", True, 6, 128, True),
+    ("level 6, >= 256 bytes", True, 6, 256, True),
+    ("level 9, >= 256 bytes", True, 9, 256, True),
+    ("level 6, all frames, no takeover", True, 6, 0, False),
+]
+
+
+def message_text(rng: random.Random) -> str:
+    # Mostly short chat lines with the occasional long paragraph
+    count = rng.randint(1, 12) if rng.random() < 0.9 else rng.randint(40, 160)
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def build_frames(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX)
+    clock = datetime(2024, 1, 1)
+    message_id = 1000
+    frames = []
+    for kind in rng.choices(kinds, weights, k=count):
+        clock += timedelta(milliseconds=rng.randint(10, 3000))
+        sender, recipient = rng.sample(USERS, 2)
+        timestamp = clock.isoformat()
+        if kind == "message":
+            message_id += 1
+            text = message_text(rng)
+            payload = {
+                "type": "message",
+                "sender_id": USERS.index(sender) + 1,
+                "sender_username": sender,
+                "recipient_id": USERS.index(recipient) + 1,
+                "recipient_username": recipient,
+                "message_text": text,
+                "timestamp": timestamp,
+                "message_id": message_id,
+                "conversation_id": f"conv_{min(USERS.index(sender), USERS.index(recipient)) + 1}_{max(USERS.index(sender), USERS.index(recipient)) + 1}",
+                "notification_type": "new_message",
+                "message_preview": text[:50] + "..." if len(text) > 50 else text,
+            }
+        elif kind == "typing_indicator":
+            payload = {"type": "typing_indicator", "username": sender, "is_typing": rng.random() < 0.6, "timestamp": timestamp}
+        elif kind == "message_sent":
+            payload = {"type": "message_sent", "message_id": message_id, "timestamp": timestamp}
+        elif kind == "read_receipt":
+            payload = {"type": "read_receipt", "message_id": message_id, "read_by": recipient, "timestamp": timestamp}
+        else:
+            payload = {
+                "type": "user_status_update",
+                "user_id": USERS.index(sender) + 1,
+                "username": sender,
+                "status": rng.choice(["online", "offline"]),
+                "timestamp": timestamp,
+            }
+        frames.append(Frame(Opcode.TEXT, encode(payload).encode()))
+    return frames
+
+
+def replay(frames: list, enabled: bool, level: int, min_size: int, context_takeover: bool):
+    """Return (payload bytes on the wire, CPU seconds spent compressing)"""
+    if not enabled:
+        return sum(len(frame.data) for frame in frames), 0.0
+    extension = ThresholdPerMessageDeflate(
+        False,
+        not context_takeover,
+        WS_COMPRESSION_WINDOW_BITS,
+        WS_COMPRESSION_WINDOW_BITS,
+        {"level": level, "memLevel": 5},
+        min_size=min_size,
+    )
+    started = time.process_time()
+    sent = sum(len(extension.encode(frame).data) for frame in frames)
+    return sent, time.process_time() - started
+
+
+def main(count: int, seed: int):
+    frames = build_frames(count, seed)
+    raw = sum(len(frame.data) for frame in frames)
+    print(f"{count:,} frames, {raw / 1024:,.1f} KiB uncompressed, average {raw / count:.0f} bytes\n")
+    print(f"{'setting':<36}{'KiB sent':>10}{'saved':>8}{'us/frame':>10}")
+    for label, enabled, level, min_size, context_takeover in CONFIGS:
+        sent, cpu = replay(frames, enabled, level, min_size, context_takeover)
+        print(f"{label:<36}{sent / 1024:>10,.1f}{1 - sent / raw:>8.0%}{cpu / count * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    main(args.frames, args.seed)
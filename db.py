@@ -1,18 +1,581 @@
 import aiosqlite
+import asyncio
+import re
+import time
 import uuid
 
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from models.auth import UserInDB
-from utils.security import verify_password
+from utils.cache import FriendGraph, UserCache
+from utils.security import password_hasher
 
 load_dotenv()
 
+# SQLite pragma sets applied to every connection at connect time
+CONNECTION_PROFILES = {
+    "default": {},
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+
+def load_connection_profile(name=None):
+    """Build the pragma set for a profile, applying any DB_* environment overrides"""
+    name = name or os.getenv("DB_PROFILE", "wal")
+    if name not in CONNECTION_PROFILES:
+        raise ValueError(f"Unknown database profile: {name}")
+    pragmas = dict(CONNECTION_PROFILES[name])
+    overrides = {
+        "journal_mode": os.getenv("DB_JOURNAL_MODE"),
+        "synchronous": os.getenv("DB_SYNCHRONOUS"),
+        "mmap_size": os.getenv("DB_MMAP_SIZE"),
+        "cache_size": os.getenv("DB_CACHE_SIZE"),
+        "busy_timeout": os.getenv("DB_BUSY_TIMEOUT"),
+    }
+    for pragma, value in overrides.items():
+        if value is not None:
+            pragmas[pragma] = value
+    return name, pragmas
+
+
+# Hot queries, shared with the EXPLAIN QUERY PLAN check in Database.check_query_plans()
+CONVERSATION_QUERY = """
+    SELECT 
+        m.id,
+        m.sender_id,
+        m.recipient_id,
+        m.message_text,
+        m.timestamp,
+        m.id <= COALESCE(rc.last_read_message_id, 0) as is_read,
+        u.username as sender_username
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN read_cursors rc ON rc.user_id = m.recipient_id AND rc.other_user_id = m.sender_id
+    WHERE m.conversation_id = ? AND m.id < ?
+    ORDER BY m.id DESC
+    LIMIT ?
+"""
+
+CONVERSATION_AFTER_QUERY = """
+    SELECT 
+        m.id,
+        m.sender_id,
+        m.recipient_id,
+        m.message_text,
+        m.timestamp,
+        m.id <= COALESCE(rc.last_read_message_id, 0) as is_read,
+        u.username as sender_username
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN read_cursors rc ON rc.user_id = m.recipient_id AND rc.other_user_id = m.sender_id
+    WHERE m.conversation_id = ? AND m.id > ?
+    ORDER BY m.id ASC
+    LIMIT ?
+"""
+
+RECENT_CONVERSATIONS_QUERY = """
+    SELECT 
+        c.other_user_id,
+        u.username,
+        u.email,
+        c.conversation_id,
+        c.last_message_time,
+        c.last_message_text,
+        c.last_message_sender,
+        COALESCE(uc.count, 0) as unread_count
+    FROM conversations c
+    JOIN users u ON c.other_user_id = u.id
+    LEFT JOIN unread_counts uc ON uc.user_id = c.user_id AND uc.other_user_id = c.other_user_id
+    WHERE c.user_id = ?
+    ORDER BY c.last_message_id DESC
+    LIMIT ?
+"""
+
+# Moves both participants' conversation summary rows to the given message
+UPDATE_CONVERSATION_QUERY = """
+    INSERT INTO conversations (
+        user_id, other_user_id, conversation_id,
+        last_message_id, last_message_text, last_message_time, last_message_sender
+    )
+    SELECT ?, ?, conversation_id, id, message_text, timestamp, sender_id
+    FROM messages
+    WHERE id = ?
+    ON CONFLICT (user_id, other_user_id) DO UPDATE SET
+        last_message_id = excluded.last_message_id,
+        last_message_text = excluded.last_message_text,
+        last_message_time = excluded.last_message_time,
+        last_message_sender = excluded.last_message_sender
+"""
+
+# Rebuilds the conversation summaries from the latest message of every conversation
+BACKFILL_CONVERSATIONS_QUERY = """
+    INSERT OR REPLACE INTO conversations (
+        user_id, other_user_id, conversation_id,
+        last_message_id, last_message_text, last_message_time, last_message_sender
+    )
+    SELECT participant.user_id, participant.other_user_id, m.conversation_id,
+           m.id, m.message_text, m.timestamp, m.sender_id
+    FROM messages m
+    JOIN (
+        SELECT user_id, other_user_id, MAX(message_id) as last_message_id
+        FROM (
+            SELECT sender_id as user_id, recipient_id as other_user_id, id as message_id FROM messages
+            UNION ALL
+            SELECT recipient_id as user_id, sender_id as other_user_id, id as message_id FROM messages
+        )
+        GROUP BY user_id, other_user_id
+    ) participant ON participant.last_message_id = m.id
+"""
+
+FRIENDS_LIST_QUERY = """
+    SELECT 
+        CASE 
+            WHEN f.user_id = ? THEN f.friend_id
+            ELSE f.user_id
+        END as friend_id,
+        u.username, u.email,
+        COALESCE(uc.count, 0) as unread_count
+    FROM friends f
+    JOIN users u ON (
+        CASE 
+            WHEN f.user_id = ? THEN f.friend_id
+            ELSE f.user_id
+        END = u.id
+    )
+    LEFT JOIN unread_counts uc ON uc.user_id = ? AND uc.other_user_id = u.id
+    WHERE (f.user_id = ? OR f.friend_id = ?) AND f.status = 'accepted'
+    GROUP BY friend_id
+    ORDER BY u.username
+"""
+
+FRIEND_REQUESTS_QUERY = """
+    SELECT f.id, f.user_id, f.created_at, u.username, u.email
+    FROM friends f
+    JOIN users u ON f.user_id = u.id
+    WHERE f.friend_id = ? AND f.status = 'pending'
+    ORDER BY f.created_at DESC
+"""
+
+# Moves a reader's cursor in a conversation forward, never back; changes no row otherwise
+ADVANCE_READ_CURSOR_QUERY = """
+    INSERT INTO read_cursors (user_id, other_user_id, last_read_message_id) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, other_user_id) DO UPDATE SET
+        last_read_message_id = excluded.last_read_message_id,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE excluded.last_read_message_id > read_cursors.last_read_message_id
+"""
+
+# Newest message from a sender to a reader at or below a given id
+LATEST_RECEIVED_FROM_QUERY = "SELECT MAX(id) FROM messages WHERE recipient_id = ? AND sender_id = ? AND id <= ?"
+
+# Unread counter of a conversation after its read cursor moved; no row when nothing is left unread
+RECOUNT_UNREAD_QUERY = """
+    INSERT INTO unread_counts (user_id, other_user_id, count)
+    SELECT ?, ?, COUNT(*) FROM messages WHERE recipient_id = ? AND sender_id = ? AND id > ?
+    HAVING COUNT(*) > 0
+"""
+
+INCREMENT_UNREAD_QUERY = """
+    INSERT INTO unread_counts (user_id, other_user_id, count) VALUES (?, ?, 1)
+    ON CONFLICT (user_id, other_user_id) DO UPDATE SET count = count + 1
+"""
+
+RESET_UNREAD_QUERY = "DELETE FROM unread_counts WHERE user_id = ? AND other_user_id = ?"
+
+# Returns no row when the sender already stored a message under the same client id
+INSERT_MESSAGE_QUERY = """
+    INSERT INTO messages (conversation_id, sender_id, recipient_id, message_text, client_message_id)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (sender_id, client_message_id) WHERE client_message_id IS NOT NULL DO NOTHING
+    RETURNING id, timestamp
+"""
+
+CLIENT_MESSAGE_QUERY = "SELECT id, timestamp FROM messages WHERE sender_id = ? AND client_message_id = ?"
+
+USER_BY_USERNAME_QUERY = "SELECT * FROM users WHERE username = ?"
+
+FRIEND_IDS_QUERY = """
+    SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted'
+    UNION
+    SELECT user_id FROM friends WHERE friend_id = ? AND status = 'accepted'
+"""
+
+MESSAGE_PARTICIPANTS_QUERY = "SELECT sender_id, recipient_id FROM messages WHERE id = ?"
+
+# Messages a user received after a cursor, replayed when a WebSocket resumes
+MISSED_MESSAGES_QUERY = """
+    SELECT
+        m.id,
+        m.sender_id,
+        u.username as sender_username,
+        m.message_text,
+        m.timestamp,
+        m.conversation_id,
+        m.id <= COALESCE(rc.last_read_message_id, 0) as is_read
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    LEFT JOIN read_cursors rc ON rc.user_id = m.recipient_id AND rc.other_user_id = m.sender_id
+    WHERE m.recipient_id = ? AND m.id > ?
+    ORDER BY m.id
+    LIMIT ?
+"""
+
+LAST_RECEIVED_MESSAGE_QUERY = "SELECT MAX(id) FROM messages WHERE recipient_id = ?"
+
+# Upper bound used as the cursor when fetching the newest page of a conversation
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+# Query name -> (SQL, sample parameters) checked by Database.check_query_plans()
+HOT_QUERIES = {
+    "conversation": (CONVERSATION_QUERY, ("conv_1_2", MAX_MESSAGE_ID, 51)),
+    "conversation_after": (CONVERSATION_AFTER_QUERY, ("conv_1_2", 0, 51)),
+    "recent_conversations": (RECENT_CONVERSATIONS_QUERY, (1, 10)),
+    "friends_list": (FRIENDS_LIST_QUERY, (1, 1, 1, 1, 1)),
+    "friend_requests": (FRIEND_REQUESTS_QUERY, (1,)),
+    "reset_unread": (RESET_UNREAD_QUERY, (1, 2)),
+    "latest_received_from": (LATEST_RECEIVED_FROM_QUERY, (1, 2, MAX_MESSAGE_ID)),
+    "recount_unread": (RECOUNT_UNREAD_QUERY, (1, 2, 1, 2, 0)),
+    "user_by_username": (USER_BY_USERNAME_QUERY, ("username",)),
+    "friend_ids": (FRIEND_IDS_QUERY, (1, 1)),
+    "message_participants": (MESSAGE_PARTICIPANTS_QUERY, (1,)),
+    "missed_messages": (MISSED_MESSAGES_QUERY, (1, 0, 101)),
+    "client_message": (CLIENT_MESSAGE_QUERY, (1, "client-id")),
+    "last_received_message": (LAST_RECEIVED_MESSAGE_QUERY, (1,)),
+}
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    # 1: composite indexes matching the message and friend access paths
+    [
+        "DROP INDEX IF EXISTS idx_messages_conversation_id",
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp ON messages (conversation_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient_sender_read ON messages (recipient_id, sender_id, is_read)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_recipient ON messages (sender_id, recipient_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_friends_friend_status ON friends (friend_id, status)",
+    ],
+    # 2: unique usernames and emails
+    [
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email)",
+    ],
+    # 3: conversation pages are keyed on message id rather than timestamp
+    [
+        "DROP INDEX IF EXISTS idx_messages_conversation_timestamp",
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_message ON messages (conversation_id, id)",
+    ],
+    # 4: denormalized unread counters per (recipient, sender), backfilled from messages
+    [
+        """
+        CREATE TABLE IF NOT EXISTS unread_counts (
+            user_id INTEGER NOT NULL,
+            other_user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, other_user_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR REPLACE INTO unread_counts (user_id, other_user_id, count)
+        SELECT recipient_id, sender_id, COUNT(*)
+        FROM messages
+        WHERE is_read = FALSE
+        GROUP BY recipient_id, sender_id
+        """,
+    ],
+    # 5: materialized per-participant conversation summaries for the recent-conversations sidebar
+    [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            other_user_id INTEGER NOT NULL,
+            conversation_id TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            last_message_text TEXT NOT NULL,
+            last_message_time TIMESTAMP NOT NULL,
+            last_message_sender INTEGER NOT NULL,
+            PRIMARY KEY (user_id, other_user_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_conversations_user_last_message ON conversations (user_id, last_message_id)",
+        BACKFILL_CONVERSATIONS_QUERY,
+    ],
+    # 6: a recipient's messages in id order, for resuming WebSockets from a cursor
+    [
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient_message ON messages (recipient_id, id)",
+    ],
+    # 7: client-generated message ids, unique per sender, so retransmitted messages are stored once
+    [
+        "ALTER TABLE messages ADD COLUMN client_message_id TEXT",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_sender_client_message
+        ON messages (sender_id, client_message_id) WHERE client_message_id IS NOT NULL
+        """,
+    ],
+    # 8: one read cursor (newest message read) per reader and conversation replaces per-message is_read
+    [
+        """
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            user_id INTEGER NOT NULL,
+            other_user_id INTEGER NOT NULL,
+            last_read_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, other_user_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT OR REPLACE INTO read_cursors (user_id, other_user_id, last_read_message_id)
+        SELECT recipient_id, sender_id, MAX(id)
+        FROM messages
+        WHERE is_read = TRUE
+        GROUP BY recipient_id, sender_id
+        """,
+        "DROP INDEX IF EXISTS idx_messages_recipient_sender_read",
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient_sender_message ON messages (recipient_id, sender_id, id)",
+        # Unread now means newer than the cursor
+        "DELETE FROM unread_counts",
+        """
+        INSERT INTO unread_counts (user_id, other_user_id, count)
+        SELECT m.recipient_id, m.sender_id, COUNT(*)
+        FROM messages m
+        LEFT JOIN read_cursors rc ON rc.user_id = m.recipient_id AND rc.other_user_id = m.sender_id
+        WHERE m.id > COALESCE(rc.last_read_message_id, 0)
+        GROUP BY m.recipient_id, m.sender_id
+        """,
+    ],
+]
+
+# How long (ms) a starting worker waits for another one that is applying migrations
+MIGRATION_BUSY_TIMEOUT = int(os.getenv("DB_MIGRATION_BUSY_TIMEOUT", 60000))
+
+# What to fix by hand when a migration fails on existing data
+MIGRATION_HINTS = {
+    2: (
+        "Older versions did not enforce unique usernames or emails; rename or remove the duplicates listed by "
+        "SELECT username, COUNT(*) FROM users GROUP BY username HAVING COUNT(*) > 1 "
+        "(and the same for email), then restart"
+    ),
+}
+
+TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+
+
+class ConnectionPool:
+    """Fixed-size pool of aiosqlite connections with checkout/return semantics"""
+
+    def __init__(self, db_name: str, size: int, pragmas: dict = None):
+        self.db_name = db_name
+        self.size = size
+        self.pragmas = pragmas or {}
+        self.connections = []
+        self._idle = asyncio.Queue()
+        # Pool-wait metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.db_name)
+            for pragma, value in self.pragmas.items():
+                await conn.execute(f"PRAGMA {pragma} = {value}")
+            self.connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+        self._idle = asyncio.Queue()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Check out a connection, waiting if all of them are in use"""
+        started = time.perf_counter()
+        if self._idle.empty():
+            self.waits += 1
+        conn = await self._idle.get()
+        waited = time.perf_counter() - started
+        self.checkouts += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "wait_ms_total": round(self.wait_time_total * 1000, 3),
+            "wait_ms_max": round(self.wait_time_max * 1000, 3),
+            "wait_ms_avg": round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+        }
+
+
+class MessageBatcher:
+    """Write-behind batcher that group-commits chat messages from all sessions"""
+
+    def __init__(
+        self,
+        db,
+        max_batch=int(os.getenv("MESSAGE_BATCH_SIZE", 64)),
+        max_delay_ms=float(os.getenv("MESSAGE_BATCH_DELAY_MS", 5)),
+        max_queue=int(os.getenv("MESSAGE_QUEUE_SIZE", 1000)),
+    ):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self._closed = False
+        self.batches = 0
+        self.messages = 0
+        self.duplicates = 0
+
+    def start(self):
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, sender_id: int, recipient_id: int, message_text: str, client_message_id: str = None):
+        """Queue a message and wait until its batch is committed
+
+        Returns (message_id, timestamp, created) as Database.insert_message does.
+        """
+        if self._closed:
+            raise RuntimeError("Message batcher is closed")
+        future = asyncio.get_running_loop().create_future()
+        # Blocks while the queue is full, pushing back on the senders
+        await self._queue.put(((sender_id, recipient_id, message_text, client_message_id), future))
+        return await future
+
+    async def close(self):
+        """Stop accepting messages and flush everything already queued"""
+        self._closed = True
+        if self._task:
+            # The sentinel makes the worker flush its current batch and exit
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+        for start in range(0, len(batch), self.max_batch):
+            await self._flush(batch[start:start + self.max_batch])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    await self._flush(batch)
+                    return
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        """Write and commit a batch, resolving every message's future; never raises into _run"""
+        try:
+            results = await self._write(batch)
+        except Exception as e:
+            # Nothing in the batch was committed, so every message still waiting fails
+            print(f"Error committing message batch: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.messages += len(results)
+        self.duplicates += sum(1 for _, (_, _, created) in results if not created)
+        for future, result in results:
+            if not future.done():
+                future.set_result(result)
+
+    async def _write(self, batch):
+        results = []
+        async with self.db.writer() as conn:
+            try:
+                # Open the batch transaction explicitly, otherwise releasing the first savepoint commits it
+                if not conn.in_transaction:
+                    await conn.execute("BEGIN")
+                for message, future in batch:
+                    # Each message writes several rows; a savepoint undoes all of them if any fails
+                    await conn.execute("SAVEPOINT batch_message")
+                    try:
+                        result = await self.db.insert_message(conn, *message)
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO batch_message")
+                        await conn.execute("RELEASE batch_message")
+                        if not future.done():
+                            future.set_exception(e)
+                        continue
+                    await conn.execute("RELEASE batch_message")
+                    results.append((future, result))
+                await conn.commit()
+            except Exception:
+                try:
+                    await conn.rollback()
+                except Exception as e:
+                    print(f"Error rolling back message batch: {e}")
+                raise
+        return results
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / self.batches, 2) if self.batches else 0.0,
+            "duplicates": self.duplicates,
+        }
+
+
 class Database:
 
-    def __init__(self, db_name=os.getenv("DB_NAME")):
+    def __init__(self, db_name=os.getenv("DB_NAME"), read_pool_size=int(os.getenv("DB_READ_POOL_SIZE", 4))):
         self.db_name = db_name
         self.conn = None
+        # Pooled mode: N read connections plus the dedicated writer connection (self.conn).
+        # An in-memory database is private to its connection, so it can't be pooled.
+        if db_name in (None, "", ":memory:"):
+            read_pool_size = 0
+        self.read_pool_size = read_pool_size
+        self.read_pool = None
+        self.write_pool = None
+        self.profile_name, self.pragmas = load_connection_profile()
+        self.user_cache = UserCache(
+            int(os.getenv("USER_CACHE_SIZE", 1024)),
+            float(os.getenv("USER_CACHE_TTL", 300)),
+        )
+        # Accepted friend ids per user, used for friendship checks and presence
+        self.friend_graph = FriendGraph(
+            int(os.getenv("FRIEND_CACHE_SIZE", 4096)),
+            float(os.getenv("FRIEND_CACHE_TTL", 300)),
+        )
 
 
     async def create_tables(self):
@@ -57,27 +620,134 @@ class Database:
             )
         """)
         
-        # Create index on conversation_id for better performance
-        await self.conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_messages_conversation_id 
-            ON messages (conversation_id)
-        """)
-        
         await self.commit()
+        await self.migrate()
+
+    async def migrate(self):
+        """Apply pending schema migrations, returning the resulting schema version
+
+        Safe to run from several workers at once: each step takes the write lock with
+        BEGIN IMMEDIATE and re-reads the version, so a step is applied exactly once.
+        """
+        async with self.writer() as conn:
+            async with conn.execute("PRAGMA busy_timeout") as cursor:
+                busy_timeout = (await cursor.fetchone())[0]
+            # Another worker may hold the write lock for the whole of a long migration
+            await conn.execute(f"PRAGMA busy_timeout = {max(busy_timeout, MIGRATION_BUSY_TIMEOUT)}")
+            try:
+                while True:
+                    number = None
+                    try:
+                        await conn.execute("BEGIN IMMEDIATE")
+                        async with conn.execute("PRAGMA user_version") as cursor:
+                            version = (await cursor.fetchone())[0]
+                        if version >= len(MIGRATIONS):
+                            await conn.rollback()
+                            break
+                        number = version + 1
+                        for statement in MIGRATIONS[version]:
+                            await conn.execute(statement)
+                        await conn.execute(f"PRAGMA user_version = {number}")
+                        await conn.commit()
+                    except Exception as e:
+                        await conn.rollback()
+                        # Later migrations and queries assume this one applied, so stop startup here
+                        if number is None:
+                            raise RuntimeError(f"Error starting schema migration: {e}") from e
+                        hint = MIGRATION_HINTS.get(number)
+                        raise RuntimeError(
+                            f"Error applying migration {number}: {e}" + (f". {hint}" if hint else "")
+                        ) from e
+                    print(f"Applied migration {number}")
+            finally:
+                await conn.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+        return version
+
+    async def check_query_plans(self):
+        """Run EXPLAIN QUERY PLAN on the hot queries and return the ones doing full table scans"""
+        async with self.reader() as conn:
+            async with conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'") as cursor:
+                tables = {row[0] for row in await cursor.fetchall()}
+            full_scans = {}
+            for name, (query, params) in HOT_QUERIES.items():
+                # Plans refer to tables by alias, so collect the names used for real tables
+                scanned_names = set()
+                for table, alias in TABLE_REFERENCE.findall(query):
+                    if table in tables:
+                        scanned_names.add(table)
+                        if alias and alias.upper() not in ("ON", "WHERE", "SET", "JOIN", "ORDER", "GROUP", "LIMIT"):
+                            scanned_names.add(alias)
+                async with conn.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+                    plan = [row[3] for row in await cursor.fetchall()]
+                scans = [step for step in plan if step.startswith("SCAN ") and step.split()[1] in scanned_names]
+                if scans:
+                    full_scans[name] = scans
+        return full_scans
+
+    async def backfill_conversations(self):
+        """Rebuild the conversation summary table from the messages table"""
+        async with self.writer() as conn:
+            await conn.execute("DELETE FROM conversations")
+            await conn.execute(BACKFILL_CONVERSATIONS_QUERY)
+            await conn.commit()
+            async with conn.execute("SELECT COUNT(*) FROM conversations") as cursor:
+                return (await cursor.fetchone())[0]
 
     async def connect(self):
-        
-        self.conn = await aiosqlite.connect(self.db_name)
+        # The writer opens first so that persistent settings like journal_mode
+        # are in place before the readers attach
+        self.write_pool = ConnectionPool(self.db_name, 1, self.pragmas)
+        await self.write_pool.open()
+        self.conn = self.write_pool.connections[0]
+        if self.read_pool_size > 0:
+            self.read_pool = ConnectionPool(self.db_name, self.read_pool_size, self.pragmas)
+            await self.read_pool.open()
+
+    async def active_profile(self):
+        """Read back the pragma values actually in effect on the writer connection"""
+        settings = {"profile": self.profile_name}
+        for pragma in ("journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store", "busy_timeout"):
+            async with self.conn.execute(f"PRAGMA {pragma}") as cursor:
+                row = await cursor.fetchone()
+            settings[pragma] = row[0] if row else None
+        return settings
 
     async def close(self):
-        await self.conn.close()
+        if self.read_pool:
+            await self.read_pool.close()
+            self.read_pool = None
+        await self.write_pool.close()
+        self.conn = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """Check out a read connection (the writer connection when not pooled)"""
+        if self.read_pool:
+            async with self.read_pool.acquire() as conn:
+                yield conn
+        else:
+            yield self.conn
+
+    @asynccontextmanager
+    async def writer(self):
+        """Check out the dedicated writer connection"""
+        async with self.write_pool.acquire() as conn:
+            yield conn
+
+    def pool_stats(self):
+        return {
+            "reader": self.read_pool.stats() if self.read_pool else None,
+            "writer": self.write_pool.stats() if self.write_pool else None,
+        }
 
     async def commit(self):
-        await self.conn.commit()
+        async with self.writer() as conn:
+            await conn.commit()
 
     async def execute(self, query, params=None):
-        cursor = await self.conn.execute(query, params)
-        await self.conn.commit()
+        async with self.writer() as conn:
+            cursor = await conn.execute(query, params)
+            await conn.commit()
         return cursor
 
     async def fetchall(self, query, params=None):
@@ -89,21 +759,28 @@ class Database:
         return await cursor.fetchone()
     
     async def get_user_by_username(self, username: str):
+        user = self.user_cache.get_by_username(username)
+        if user:
+            return user
         if not self.conn:
             return None
-        async with self.conn.execute("SELECT * FROM users WHERE username = ?", (username,)) as cursor:
-            user_tuple = await cursor.fetchone()
+        async with self.reader() as conn:
+            async with conn.execute(USER_BY_USERNAME_QUERY, (username,)) as cursor:
+                user_tuple = await cursor.fetchone()
         if user_tuple:
             user_dict = dict(zip(["id", "username", "email", "password"], user_tuple))
-            return UserInDB(**user_dict)
+            user = UserInDB(**user_dict)
+            self.user_cache.add(user)
+            return user
         else:
             return None
 
     async def get_user_by_email(self, email: str):
         if not self.conn:
             return None
-        async with self.conn.execute("SELECT * FROM users WHERE email = ?", (email,)) as cursor:
-            user_tuple = await cursor.fetchone()
+        async with self.reader() as conn:
+            async with conn.execute("SELECT * FROM users WHERE email = ?", (email,)) as cursor:
+                user_tuple = await cursor.fetchone()
         if user_tuple:
             user_dict = dict(zip(["id", "username", "email", "password"], user_tuple))
             return UserInDB(**user_dict)
@@ -111,77 +788,101 @@ class Database:
             return None
 
     async def get_user_by_id(self, user_id: int):
+        user = self.user_cache.get_by_id(user_id)
+        if user:
+            return user
         if not self.conn:
             return None
-        async with self.conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
-            user_tuple = await cursor.fetchone()
+        async with self.reader() as conn:
+            async with conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
+                user_tuple = await cursor.fetchone()
         if user_tuple:
             user_dict = dict(zip(["id", "username", "email", "password"], user_tuple))
-            return UserInDB(**user_dict)
+            user = UserInDB(**user_dict)
+            self.user_cache.add(user)
+            return user
         else:
             return None
 
     async def get_all_users(self):
         if not self.conn:
             return []
-        async with self.conn.execute("SELECT * FROM users") as cursor:
-            user_tuples = await cursor.fetchall()
+        async with self.reader() as conn:
+            async with conn.execute("SELECT * FROM users") as cursor:
+                user_tuples = await cursor.fetchall()
         users = []
         for user_tuple in user_tuples:
             user_dict = dict(zip(["id", "username", "email", "password"], user_tuple))
             users.append(UserInDB(**user_dict))
         return users
 
+    async def create_user(self, username: str, email: str, hashed_password: str):
+        """Insert a new user, returning its ID"""
+        async with self.writer() as conn:
+            cursor = await conn.execute(
+                "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                (username, email, hashed_password)
+            )
+            await conn.commit()
+        self.invalidate_user(username=username, user_id=cursor.lastrowid)
+        return cursor.lastrowid
+
+    def invalidate_user(self, username: str = None, user_id: int = None):
+        """Drop a user from the cache after it is created or changed"""
+        self.user_cache.invalidate(username=username, user_id=user_id)
+
     async def verify_password(self, username: str, password: str):
         user = await self.get_user_by_username(username)
         if not user:
             return False
-        # Assuming you have a password hash stored in the database
-        return verify_password(password, user.password)
+        # bcrypt runs off the event loop
+        return await password_hasher.verify(password, user.password)
 
     # Friend-related methods
     async def send_friend_request(self, user_id: int, friend_id: int):
         """Send a friend request to another user"""
         try:
-            # Check if already friends
-            existing_friendship = await self.conn.execute(
-                "SELECT * FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
-                (user_id, friend_id, friend_id, user_id)
-            )
-            existing = await existing_friendship.fetchone()
+            async with self.writer() as conn:
+                # Check if already friends
+                existing_friendship = await conn.execute(
+                    "SELECT * FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
+                    (user_id, friend_id, friend_id, user_id)
+                )
+                existing = await existing_friendship.fetchone()
             
-            if existing:
-                # Check if it's already accepted
-                if existing[3] == 'accepted':  # status column
-                    return False  # Already friends
-                elif existing[3] == 'pending':
-                    # Check if this is a mutual request (both users sent requests to each other)
-                    if existing[1] == user_id and existing[2] == friend_id:
-                        # User is sending to friend, check if friend also sent to user
-                        mutual_check = await self.conn.execute(
-                            "SELECT * FROM friends WHERE user_id = ? AND friend_id = ? AND status = 'pending'",
-                            (friend_id, user_id)
-                        )
-                        mutual = await mutual_check.fetchone()
-                        
-                        if mutual:
-                            # Mutual request detected! Auto-accept both
-                            await self.conn.execute(
-                                "UPDATE friends SET status = 'accepted' WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
-                                (user_id, friend_id, friend_id, user_id)
+                if existing:
+                    # Check if it's already accepted
+                    if existing[3] == 'accepted':  # status column
+                        return False  # Already friends
+                    elif existing[3] == 'pending':
+                        # Check if this is a mutual request (both users sent requests to each other)
+                        if existing[1] == user_id and existing[2] == friend_id:
+                            # User is sending to friend, check if friend also sent to user
+                            mutual_check = await conn.execute(
+                                "SELECT * FROM friends WHERE user_id = ? AND friend_id = ? AND status = 'pending'",
+                                (friend_id, user_id)
                             )
-                            await self.commit()
-                            return True  # Mutual friendship created
+                            mutual = await mutual_check.fetchone()
+                        
+                            if mutual:
+                                # Mutual request detected! Auto-accept both
+                                await conn.execute(
+                                    "UPDATE friends SET status = 'accepted' WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
+                                    (user_id, friend_id, friend_id, user_id)
+                                )
+                                await conn.commit()
+                                self.friend_graph.add_edge(user_id, friend_id)
+                                return True  # Mutual friendship created
                     
-                    return False  # Request already exists
+                        return False  # Request already exists
             
-            # Insert new friend request
-            await self.conn.execute(
-                "INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, 'pending')",
-                (user_id, friend_id)
-            )
-            await self.commit()
-            return True
+                # Insert new friend request
+                await conn.execute(
+                    "INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, 'pending')",
+                    (user_id, friend_id)
+                )
+                await conn.commit()
+                return True
         except Exception as e:
             print(f"Error sending friend request: {e}")
             return False
@@ -189,12 +890,15 @@ class Database:
     async def accept_friend_request(self, user_id: int, friend_id: int):
         """Accept a friend request"""
         try:
-            # Update the friend request to accepted
-            await self.conn.execute(
-                "UPDATE friends SET status = 'accepted' WHERE user_id = ? AND friend_id = ?",
-                (friend_id, user_id)
-            )
-            await self.commit()
+            async with self.writer() as conn:
+                # Update the friend request to accepted
+                cursor = await conn.execute(
+                    "UPDATE friends SET status = 'accepted' WHERE user_id = ? AND friend_id = ?",
+                    (friend_id, user_id)
+                )
+                await conn.commit()
+            if cursor.rowcount:
+                self.friend_graph.add_edge(user_id, friend_id)
             return True
         except Exception as e:
             print(f"Error accepting friend request: {e}")
@@ -203,12 +907,13 @@ class Database:
     async def reject_friend_request(self, user_id: int, friend_id: int):
         """Reject a friend request"""
         try:
-            await self.conn.execute(
-                "DELETE FROM friends WHERE user_id = ? AND friend_id = ? AND status = 'pending'",
-                (friend_id, user_id)
-            )
-            await self.commit()
-            return True
+            async with self.writer() as conn:
+                await conn.execute(
+                    "DELETE FROM friends WHERE user_id = ? AND friend_id = ? AND status = 'pending'",
+                    (friend_id, user_id)
+                )
+                await conn.commit()
+                return True
         except Exception as e:
             print(f"Error rejecting friend request: {e}")
             return False
@@ -216,14 +921,9 @@ class Database:
     async def get_friend_requests(self, user_id: int):
         """Get pending friend requests for a user"""
         try:
-            cursor = await self.conn.execute("""
-                SELECT f.id, f.user_id, f.created_at, u.username, u.email
-                FROM friends f
-                JOIN users u ON f.user_id = u.id
-                WHERE f.friend_id = ? AND f.status = 'pending'
-                ORDER BY f.created_at DESC
-            """, (user_id,))
-            rows = await cursor.fetchall()
+            async with self.reader() as conn:
+                cursor = await conn.execute(FRIEND_REQUESTS_QUERY, (user_id,))
+                rows = await cursor.fetchall()
             return [
                 {
                     "id": row[0],
@@ -241,14 +941,15 @@ class Database:
     async def get_sent_friend_requests(self, user_id: int):
         """Get pending friend requests sent by a user"""
         try:
-            cursor = await self.conn.execute("""
-                SELECT f.id, f.friend_id, f.created_at, u.username, u.email
-                FROM friends f
-                JOIN users u ON f.friend_id = u.id
-                WHERE f.user_id = ? AND f.status = 'pending'
-                ORDER BY f.created_at DESC
-            """, (user_id,))
-            rows = await cursor.fetchall()
+            async with self.reader() as conn:
+                cursor = await conn.execute("""
+                    SELECT f.id, f.friend_id, f.created_at, u.username, u.email
+                    FROM friends f
+                    JOIN users u ON f.friend_id = u.id
+                    WHERE f.user_id = ? AND f.status = 'pending'
+                    ORDER BY f.created_at DESC
+                """, (user_id,))
+                rows = await cursor.fetchall()
             return [
                 {
                     "id": row[0],
@@ -266,12 +967,13 @@ class Database:
     async def cancel_friend_request(self, user_id: int, friend_id: int):
         """Cancel a sent friend request"""
         try:
-            await self.conn.execute(
-                "DELETE FROM friends WHERE user_id = ? AND friend_id = ? AND status = 'pending'",
-                (user_id, friend_id)
-            )
-            await self.commit()
-            return True
+            async with self.writer() as conn:
+                await conn.execute(
+                    "DELETE FROM friends WHERE user_id = ? AND friend_id = ? AND status = 'pending'",
+                    (user_id, friend_id)
+                )
+                await conn.commit()
+                return True
         except Exception as e:
             print(f"Error canceling friend request: {e}")
             return False
@@ -279,30 +981,15 @@ class Database:
     async def get_friends_list(self, user_id: int):
         """Get accepted friends for a user"""
         try:
-            cursor = await self.conn.execute("""
-                SELECT 
-                    CASE 
-                        WHEN f.user_id = ? THEN f.friend_id
-                        ELSE f.user_id
-                    END as friend_id,
-                    u.username, u.email
-                FROM friends f
-                JOIN users u ON (
-                    CASE 
-                        WHEN f.user_id = ? THEN f.friend_id
-                        ELSE f.user_id
-                    END = u.id
-                )
-                WHERE (f.user_id = ? OR f.friend_id = ?) AND f.status = 'accepted'
-                GROUP BY friend_id
-                ORDER BY u.username
-            """, (user_id, user_id, user_id, user_id))
-            rows = await cursor.fetchall()
+            async with self.reader() as conn:
+                cursor = await conn.execute(FRIENDS_LIST_QUERY, (user_id, user_id, user_id, user_id, user_id))
+                rows = await cursor.fetchall()
             return [
                 {
                     "friend_id": row[0],
                     "username": row[1],
-                    "email": row[2]
+                    "email": row[2],
+                    "unread_count": row[3]
                 }
                 for row in rows
             ]
@@ -310,105 +997,61 @@ class Database:
             print(f"Error getting friends list: {e}")
             return []
 
+    async def get_friend_ids(self, user_id: int):
+        """Get the ids of a user's accepted friends, served from the friend cache when possible"""
+        friend_ids = self.friend_graph.get(user_id)
+        if friend_ids is not None:
+            return friend_ids
+        generation = self.friend_graph.generation(user_id)
+        try:
+            async with self.reader() as conn:
+                cursor = await conn.execute(FRIEND_IDS_QUERY, (user_id, user_id))
+                rows = await cursor.fetchall()
+        except Exception as e:
+            print(f"Error getting friend ids: {e}")
+            return frozenset()
+        friend_ids = frozenset(row[0] for row in rows)
+        # Skipped if a friendship change committed while the query ran; the next call reloads
+        self.friend_graph.set(user_id, friend_ids, generation)
+        return friend_ids
+
+    async def are_friends(self, user_id: int, other_user_id: int):
+        """Check an accepted friendship against the friend graph"""
+        return other_user_id in await self.get_friend_ids(user_id)
+
     async def remove_friend(self, user_id: int, friend_id: int):
         """Remove a friend (delete both friendship records) but preserve messages"""
         try:
-            # Delete friendship records but keep messages
-            await self.conn.execute(
-                "DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
-                (user_id, friend_id, friend_id, user_id)
-            )
-            await self.commit()
+            async with self.writer() as conn:
+                # Delete friendship records but keep messages
+                await conn.execute(
+                    "DELETE FROM friends WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)",
+                    (user_id, friend_id, friend_id, user_id)
+                )
+                await conn.commit()
+            self.friend_graph.remove_edge(user_id, friend_id)
             return True
         except Exception as e:
             print(f"Error removing friend: {e}")
             return False
 
-    async def get_conversation_with_anyone(self, user1_id: int, user2_id: int, limit: int = 50):
-        """Get conversation between two users regardless of friendship status"""
+    async def get_conversation_with_anyone(self, user1_id: int, user2_id: int, limit: int = 50,
+                                           before_id: int = None, after_id: int = None):
+        """Get a page of the conversation between two users regardless of friendship status"""
         try:
-            cursor = await self.conn.execute("""
-                SELECT 
-                    m.id,
-                    m.sender_id,
-                    m.recipient_id,
-                    m.message_text,
-                    m.timestamp,
-                    m.is_read,
-                    u.username as sender_username
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE (m.sender_id = ? AND m.recipient_id = ?) 
-                   OR (m.sender_id = ? AND m.recipient_id = ?)
-                ORDER BY m.timestamp ASC
-                LIMIT ?
-            """, (user1_id, user2_id, user2_id, user1_id, limit))
-            
-            rows = await cursor.fetchall()
-            return [
-                {
-                    "id": row[0],
-                    "sender_id": row[1],
-                    "recipient_id": row[2],
-                    "message_text": row[3],
-                    "timestamp": row[4],
-                    "is_read": bool(row[5]),
-                    "sender_username": row[6]
-                }
-                for row in rows
-            ]
+            return await self._get_conversation_page(user1_id, user2_id, limit, before_id, after_id)
         except Exception as e:
             print(f"Error getting conversation with anyone: {e}")
-            return []
+            return {"conversation": [], "has_more": False}
 
     async def get_recent_conversations(self, user_id: int, limit: int = 10):
         """Get recent conversations for a user (including former friends)"""
         try:
-            # Simpler query that gets the most recent message for each conversation
-            cursor = await self.conn.execute("""
-                WITH recent_messages AS (
-                    SELECT 
-                        CASE 
-                            WHEN m.sender_id = ? THEN m.recipient_id
-                            ELSE m.sender_id
-                        END as other_user_id,
-                        m.conversation_id,
-                        m.message_text,
-                        m.timestamp,
-                        m.sender_id,
-                        m.recipient_id,
-                        ROW_NUMBER() OVER (
-                            PARTITION BY 
-                                CASE 
-                                    WHEN m.sender_id = ? THEN m.recipient_id
-                                    ELSE m.sender_id
-                                END
-                            ORDER BY m.timestamp DESC
-                        ) as rn
-                    FROM messages m
-                    WHERE m.sender_id = ? OR m.recipient_id = ?
-                )
-                SELECT 
-                    rm.other_user_id,
-                    u.username,
-                    u.email,
-                    rm.conversation_id,
-                    rm.timestamp as last_message_time,
-                    rm.message_text as last_message_text,
-                    rm.sender_id as last_message_sender,
-                    (
-                        SELECT COUNT(*) 
-                        FROM messages m2 
-                        WHERE m2.recipient_id = ? AND m2.sender_id = rm.other_user_id AND m2.is_read = FALSE
-                    ) as unread_count
-                FROM recent_messages rm
-                JOIN users u ON rm.other_user_id = u.id
-                WHERE rm.rn = 1
-                ORDER BY rm.timestamp DESC
-                LIMIT ?
-            """, (user_id, user_id, user_id, user_id, user_id, limit))
+            # Top-N read of the conversation summaries kept up to date by insert_message
+            async with self.reader() as conn:
+                cursor = await conn.execute(RECENT_CONVERSATIONS_QUERY, (user_id, limit))
             
-            rows = await cursor.fetchall()
+                rows = await cursor.fetchall()
             return [
                 {
                     "friend_id": row[0],
@@ -426,46 +1069,85 @@ class Database:
             print(f"Error getting recent conversations: {e}")
             return []
 
-    async def save_message(self, sender_id: int, recipient_id: int, message_text: str):
-        """Save a new message to the database"""
+    @staticmethod
+    def conversation_id_for(user1_id: int, user2_id: int):
+        """Build the conversation ID shared by two users"""
+        # Sort the IDs to ensure consistent conversation ID regardless of who sends first
+        user_ids = sorted([user1_id, user2_id])
+        return f"conv_{user_ids[0]}_{user_ids[1]}"
+
+    async def insert_message(self, conn, sender_id: int, recipient_id: int, message_text: str,
+                             client_message_id: str = None):
+        """Insert a message on a writer connection without committing
+
+        Returns (message_id, timestamp, created); created is False when the sender already
+        stored a message under client_message_id, whose id and timestamp are returned instead.
+        """
+        cursor = await conn.execute(
+            INSERT_MESSAGE_QUERY,
+            (self.conversation_id_for(sender_id, recipient_id), sender_id, recipient_id, message_text,
+             client_message_id)
+        )
+        row = await cursor.fetchone()
+        if row is None:
+            # Retransmitted message: only this rare path costs a second query
+            cursor = await conn.execute(CLIENT_MESSAGE_QUERY, (sender_id, client_message_id))
+            row = await cursor.fetchone()
+            return row[0], row[1], False
+        message_id, timestamp = row
+        # Keep the recipient's unread counter and both conversation summaries
+        # in the same transaction as the message
+        await conn.execute(INCREMENT_UNREAD_QUERY, (recipient_id, sender_id))
+        await conn.executemany(
+            UPDATE_CONVERSATION_QUERY,
+            [(sender_id, recipient_id, message_id), (recipient_id, sender_id, message_id)]
+        )
+        return message_id, timestamp, True
+
+    async def save_message(self, sender_id: int, recipient_id: int, message_text: str,
+                           client_message_id: str = None):
+        """Save a new message to the database, returning its (message_id, timestamp)"""
         try:
-            # Generate a unique conversation ID based on the two users
-            # Sort the IDs to ensure consistent conversation ID regardless of who sends first
-            user_ids = sorted([sender_id, recipient_id])
-            conversation_id = f"conv_{user_ids[0]}_{user_ids[1]}"
-            
-            await self.conn.execute(
-                "INSERT INTO messages (conversation_id, sender_id, recipient_id, message_text) VALUES (?, ?, ?, ?)",
-                (conversation_id, sender_id, recipient_id, message_text)
-            )
-            await self.commit()
-            return conversation_id
+            async with self.writer() as conn:
+                message_id, timestamp, _ = await self.insert_message(
+                    conn, sender_id, recipient_id, message_text, client_message_id
+                )
+                await conn.commit()
+                return message_id, timestamp
         except Exception as e:
             print(f"Error saving message: {e}")
             return False
 
-    async def get_conversation(self, user1_id: int, user2_id: int, limit: int = 50):
-        """Get conversation between two users"""
+    async def get_conversation(self, user1_id: int, user2_id: int, limit: int = 50,
+                               before_id: int = None, after_id: int = None):
+        """Get a page of the conversation between two users"""
         try:
-            cursor = await self.conn.execute("""
-                SELECT 
-                    m.id,
-                    m.sender_id,
-                    m.recipient_id,
-                    m.message_text,
-                    m.timestamp,
-                    m.is_read,
-                    u.username as sender_username
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE (m.sender_id = ? AND m.recipient_id = ?) 
-                   OR (m.sender_id = ? AND m.recipient_id = ?)
-                ORDER BY m.timestamp ASC
-                LIMIT ?
-            """, (user1_id, user2_id, user2_id, user1_id, limit))
-            
+            return await self._get_conversation_page(user1_id, user2_id, limit, before_id, after_id)
+        except Exception as e:
+            print(f"Error getting conversation: {e}")
+            return {"conversation": [], "has_more": False}
+
+    async def _get_conversation_page(self, user1_id: int, user2_id: int, limit: int,
+                                     before_id: int = None, after_id: int = None):
+        """Get one page of a conversation in chronological order using keyset pagination"""
+        # Without a cursor this is the newest page. One extra row is fetched to tell
+        # whether more messages lie beyond the page.
+        conversation_id = self.conversation_id_for(user1_id, user2_id)
+        async with self.reader() as conn:
+            if after_id is not None:
+                cursor = await conn.execute(CONVERSATION_AFTER_QUERY, (conversation_id, after_id, limit + 1))
+            else:
+                cursor = await conn.execute(
+                    CONVERSATION_QUERY,
+                    (conversation_id, before_id if before_id is not None else MAX_MESSAGE_ID, limit + 1)
+                )
             rows = await cursor.fetchall()
-            return [
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after_id is None:
+            rows.reverse()
+        return {
+            "conversation": [
                 {
                     "id": row[0],
                     "sender_id": row[1],
@@ -476,70 +1158,110 @@ class Database:
                     "sender_username": row[6]
                 }
                 for row in rows
-            ]
+            ],
+            "has_more": has_more,
+        }
+
+    async def get_message_participants(self, message_id: int):
+        """Get (sender_id, recipient_id) of a message, or None if it does not exist"""
+        try:
+            async with self.reader() as conn:
+                cursor = await conn.execute(MESSAGE_PARTICIPANTS_QUERY, (message_id,))
+                row = await cursor.fetchone()
+            return (row[0], row[1]) if row else None
         except Exception as e:
-            print(f"Error getting conversation: {e}")
-            return []
+            print(f"Error getting message participants: {e}")
+            return None
 
-    async def mark_messages_as_read(self, user_id: int, sender_id: int):
-        """Mark messages from a specific sender as read"""
+    async def get_messages_since(self, user_id: int, after_id: int, limit: int):
+        """Get up to limit messages received by a user after the given message id, oldest first"""
         try:
-            await self.conn.execute(
-                "UPDATE messages SET is_read = TRUE WHERE recipient_id = ? AND sender_id = ? AND is_read = FALSE",
-                (user_id, sender_id)
-            )
-            await self.commit()
-            return True
+            async with self.reader() as conn:
+                cursor = await conn.execute(MISSED_MESSAGES_QUERY, (user_id, after_id, limit))
+                rows = await cursor.fetchall()
+            return [
+                {
+                    "message_id": row[0],
+                    "sender_id": row[1],
+                    "sender_username": row[2],
+                    "message_text": row[3],
+                    "timestamp": row[4],
+                    "conversation_id": row[5],
+                    "is_read": bool(row[6])
+                }
+                for row in rows
+            ]
         except Exception as e:
-            print(f"Error marking messages as read: {e}")
-            return False
+            print(f"Error getting missed messages: {e}")
+            return []
 
-    async def get_unread_message_count(self, user_id: int, friend_id: int):
-        """Get count of unread messages from a specific friend"""
-        # Force reload - ensure this method signature is correct
+    async def get_last_received_message_id(self, user_id: int):
+        """Get the id of the newest message a user received, or 0 if there is none"""
         try:
-            cursor = await self.conn.execute(
-                "SELECT COUNT(*) FROM messages WHERE recipient_id = ? AND sender_id = ? AND is_read = FALSE",
-                (user_id, friend_id)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+            async with self.reader() as conn:
+                cursor = await conn.execute(LAST_RECEIVED_MESSAGE_QUERY, (user_id,))
+                row = await cursor.fetchone()
+            return row[0] or 0
         except Exception as e:
-            print(f"Error getting unread message count: {e}")
+            print(f"Error getting last received message: {e}")
             return 0
 
-    async def get_unread_message_count_for_conversation(self, user_id: int, other_user_id: int):
-        """Get count of unread messages from a specific user in conversation"""
+    async def get_latest_received_from(self, user_id: int, sender_id: int, up_to_id: int = None):
+        """Get the id of the newest message a user received from a sender (at or below up_to_id), or None"""
         try:
-            cursor = await self.conn.execute(
-                "SELECT COUNT(*) FROM messages WHERE recipient_id = ? AND sender_id = ? AND is_read = FALSE",
-                (user_id, other_user_id)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+            async with self.reader() as conn:
+                cursor = await conn.execute(
+                    LATEST_RECEIVED_FROM_QUERY,
+                    (user_id, sender_id, up_to_id if up_to_id is not None else MAX_MESSAGE_ID)
+                )
+                row = await cursor.fetchone()
+            return row[0]
         except Exception as e:
-            print(f"Error getting unread message count for conversation: {e}")
-            return 0
+            print(f"Error getting latest received message: {e}")
+            return None
+
+    async def advance_read_cursors(self, cursors):
+        """Move (reader_id, sender_id, message_id) read cursors forward in one transaction
+
+        Returns the cursors that moved; their unread counters are recounted from the new position.
+        """
+        advanced = []
+        async with self.writer() as conn:
+            try:
+                for reader_id, sender_id, message_id in cursors:
+                    cursor = await conn.execute(ADVANCE_READ_CURSOR_QUERY, (reader_id, sender_id, message_id))
+                    if cursor.rowcount > 0:
+                        await conn.execute(RESET_UNREAD_QUERY, (reader_id, sender_id))
+                        await conn.execute(
+                            RECOUNT_UNREAD_QUERY, (reader_id, sender_id, reader_id, sender_id, message_id)
+                        )
+                        advanced.append((reader_id, sender_id, message_id))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return advanced
 
     async def search_users(self, search_term: str, exclude_user_id: int = None):
         """Search for users by username (excluding the current user)"""
         try:
-            if exclude_user_id:
-                cursor = await self.conn.execute("""
-                    SELECT id, username, email
-                    FROM users
-                    WHERE username LIKE ? AND id != ?
-                    ORDER BY username
-                """, (f"%{search_term}%", exclude_user_id))
-            else:
-                cursor = await self.conn.execute("""
-                    SELECT id, username, email
-                    FROM users
-                    WHERE username LIKE ?
-                    ORDER BY username
-                """, (f"%{search_term}%",))
+            async with self.reader() as conn:
+                if exclude_user_id:
+                    cursor = await conn.execute("""
+                        SELECT id, username, email
+                        FROM users
+                        WHERE username LIKE ? AND id != ?
+                        ORDER BY username
+                    """, (f"%{search_term}%", exclude_user_id))
+                else:
+                    cursor = await conn.execute("""
+                        SELECT id, username, email
+                        FROM users
+                        WHERE username LIKE ?
+                        ORDER BY username
+                    """, (f"%{search_term}%",))
             
-            rows = await cursor.fetchall()
+                rows = await cursor.fetchall()
             return [
                 {
                     "id": row[0],
@@ -555,31 +1277,32 @@ class Database:
     async def get_all_pending_requests(self, user_id: int):
         """Get all pending friend requests for a user (both incoming and outgoing)"""
         try:
-            cursor = await self.conn.execute("""
-                SELECT 
-                    f.id,
-                    f.user_id,
-                    f.friend_id,
-                    f.status,
-                    f.created_at,
-                    u.username,
-                    u.email,
-                    CASE 
-                        WHEN f.user_id = ? THEN 'outgoing'
-                        ELSE 'incoming'
-                    END as request_type
-                FROM friends f
-                JOIN users u ON (
-                    CASE 
-                        WHEN f.user_id = ? THEN f.friend_id
-                        ELSE f.user_id
-                    END = u.id
-                )
-                WHERE (f.user_id = ? OR f.friend_id = ?) AND f.status = 'pending'
-                ORDER BY f.created_at DESC
-            """, (user_id, user_id, user_id, user_id))
+            async with self.reader() as conn:
+                cursor = await conn.execute("""
+                    SELECT 
+                        f.id,
+                        f.user_id,
+                        f.friend_id,
+                        f.status,
+                        f.created_at,
+                        u.username,
+                        u.email,
+                        CASE 
+                            WHEN f.user_id = ? THEN 'outgoing'
+                            ELSE 'incoming'
+                        END as request_type
+                    FROM friends f
+                    JOIN users u ON (
+                        CASE 
+                            WHEN f.user_id = ? THEN f.friend_id
+                            ELSE f.user_id
+                        END = u.id
+                    )
+                    WHERE (f.user_id = ? OR f.friend_id = ?) AND f.status = 'pending'
+                    ORDER BY f.created_at DESC
+                """, (user_id, user_id, user_id, user_id))
             
-            rows = await cursor.fetchall()
+                rows = await cursor.fetchall()
             return [
                 {
                     "id": row[0],
@@ -596,3 +1319,31 @@ class Database:
         except Exception as e:
             print(f"Error getting all pending requests: {e}")
             return []
+
+
+async def _main(command: str):
+    db = Database()
+    await db.connect()
+    try:
+        await db.create_tables()
+        if command == "migrate":
+            print(f"Schema version: {await db.migrate()}")
+        elif command == "backfill-conversations":
+            print(f"Rebuilt {await db.backfill_conversations()} conversation summaries")
+        elif command == "check-plans":
+            full_scans = await db.check_query_plans()
+            for name, steps in full_scans.items():
+                print(f"{name}: {steps}")
+            if full_scans:
+                raise SystemExit(1)
+            print("No hot query does a full table scan")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Database maintenance commands")
+    parser.add_argument("command", choices=["migrate", "check-plans", "backfill-conversations"])
+    asyncio.run(_main(parser.parse_args().command))
@@ -1,5 +1,6 @@
 from codecs import encode
 from typing_extensions import Annotated
+import os
 from fastapi import Body, FastAPI, WebSocket, Depends, HTTPException, status, Request, Response
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
@@ -13,17 +14,22 @@ from models.auth import MsgPayload, MessageResponse
 from models.auth import LoginData, User, UserCreate, Token, UserInDB, FriendRequestData
 from utils.security import (
     verify_token,
+    verified_tokens,
     oauth2_scheme,
     SECRET_KEY,
     ALGORITHM,
     create_access_token,
-    verify_password,
-    get_password_hash
+    password_hasher
 )
 
-from db import Database
+from db import Database, MessageBatcher
+from utils.connections import Connection, ConnectionRegistry
+from utils.presence import PresenceEngine
+from utils.pubsub import create_pubsub
+from utils.typing_indicators import TypingThrottle
+from utils.read_receipts import ReadReceiptBatcher
+from utils.serialization import Frame, decode as decode_frame, decode_binary, select_subprotocol
 import logging
-import json
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.ERROR)
@@ -35,22 +41,53 @@ app = FastAPI(debug=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 db = Database()
+message_batcher = MessageBatcher(db)
 
 @app.on_event("startup")
 async def on_startup():
     print("Starting up!")
     await db.connect()
+    print("Database profile:", await db.active_profile())
     await db.create_tables()
+    for query_name, steps in (await db.check_query_plans()).items():
+        print(f"Warning: hot query '{query_name}' does a full table scan: {steps}")
+    message_batcher.start()
+    await bus.start()
 @app.on_event("shutdown")
 async def on_shutdown():
     print("shutting down!")
+    # Flush queued chat messages before the writer connection goes away
+    await presence.close()
+    await read_receipts.close()
+    await bus.close()
+    await message_batcher.close()
     await db.close()
-# Store active connections with user info
-connections: List[dict] = []
+# Newest /ws frame layout; clients opt in with ?v=N, older clients default to 1
+# 2: a delivered chat message carries its notification fields instead of a separate notification_update
+PROTOCOL_VERSION = 2
+
+# Active WebSocket connections of this worker, indexed by user id
+connections = ConnectionRegistry()
+# Shares deliveries and presence with the other uvicorn workers (PUBSUB_BACKEND=unix)
+bus = create_pubsub()
+# Debounced online/offline updates for friends
+presence = PresenceEngine(connections, bus, db.get_friend_ids)
 
 # In-memory storage for messages
 messages_list: dict[int, MsgPayload] = {}
 
+# Conversation history page sizes
+CONVERSATION_PAGE_SIZE = 50
+MAX_CONVERSATION_PAGE_SIZE = 200
+
+# Longest client_message_id accepted on /ws chat messages
+MAX_CLIENT_MESSAGE_ID_LENGTH = 64
+
+# Messages replayed per frame when a WebSocket resumes with ?since=<message id>
+RESUME_BATCH_SIZE = int(os.getenv("RESUME_BATCH_SIZE", 100))
+# Clients that missed more than this reload their conversations over HTTP instead
+RESUME_MAX_MESSAGES = int(os.getenv("RESUME_MAX_MESSAGES", 1000))
+
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -62,14 +99,8 @@ async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        print("Decoded payload:", payload)
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError as e:
-        print("Error:", e)
+    username = verify_token(token)
+    if username is None:
         raise credentials_exception
     user = await get_user(db, username)
     if not user:
@@ -86,16 +117,8 @@ async def get_current_user_from_cookie(request: Request):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-    except JWTError:
+    username = verify_token(token)
+    if username is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
@@ -111,9 +134,23 @@ async def get_current_user_from_cookie(request: Request):
         )
     return user
 
+async def get_request_user(request: Request):
+    """Resolve the request's user on first use, from the Authorization header or the auth cookie"""
+    # Only routes that need the user pay for token and user lookups; static files
+    # and public pages never call this
+    if not hasattr(request.state, "user"):
+        token = request.headers.get("Authorization")
+        if token:
+            token = token.replace("Bearer ", "")  # Remove the Bearer prefix
+        else:
+            # Fallback to cookie-based authentication
+            token = request.cookies.get("auth_token")
+        request.state.user = await authenticate_token(token)
+    return request.state.user
+
 async def get_current_user_from_request(request: Request):
-    """Get current user from request state (set by middleware)"""
-    user = getattr(request.state, 'user', None)
+    """Get current user from the request, requiring authentication"""
+    user = await get_request_user(request)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -125,32 +162,12 @@ async def get_current_user_from_request(request: Request):
 @app.get("/chat")
 async def chat_route(request: Request):
     """Serve the chat page template - requires authentication"""
-    # First try to get user from middleware (for API requests with headers)
-    user = getattr(request.state, 'user', None)
+    # First try the Authorization header or auth cookie
+    user = await get_request_user(request)
     
-    # If no user from middleware, check for token in query params (for browser navigation)
+    # If no user yet, check for token in query params (for browser navigation)
     if not user:
-        token = request.query_params.get("token")
-        if token:
-            try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-                username = payload.get("sub")
-                if username:
-                    user = await get_user(db, username)
-            except JWTError:
-                pass
-    
-    # If still no user, check for token in cookies as fallback
-    if not user:
-        token = request.cookies.get("auth_token")
-        if token:
-            try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-                username = payload.get("sub")
-                if username:
-                    user = await get_user(db, username)
-            except JWTError:
-                pass
+        user = await authenticate_token(request.query_params.get("token"))
     
     if not user:
         return RedirectResponse(url="/login", status_code=302)
@@ -164,32 +181,12 @@ async def chat_route(request: Request):
 @app.get("/chat/{conversation_id}")
 async def chat_conversation_route(request: Request, conversation_id: str):
     """Serve the chat page template for a specific conversation - requires authentication"""
-    # First try to get user from middleware (for API requests with headers)
-    user = getattr(request.state, 'user', None)
+    # First try the Authorization header or auth cookie
+    user = await get_request_user(request)
     
-    # If no user from middleware, check for token in query params (for browser navigation)
-    if not user:
-        token = request.query_params.get("token")
-        if token:
-            try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-                username = payload.get("sub")
-                if username:
-                    user = await get_user(db, username)
-            except JWTError:
-                pass
-    
-    # If still no user, check for token in cookies as fallback
+    # If no user yet, check for token in query params (for browser navigation)
     if not user:
-        token = request.cookies.get("auth_token")
-        if token:
-            try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-                username = payload.get("sub")
-                if username:
-                    user = await get_user(db, username)
-            except JWTError:
-                pass
+        user = await authenticate_token(request.query_params.get("token"))
     
     if not user:
         return RedirectResponse(url="/login", status_code=302)
@@ -245,15 +242,16 @@ async def signup(user_create: UserCreate):
         if user:
             raise HTTPException(status_code=400, detail="Email already exists")
 
-        # Hash the password
-        hashed_password = get_password_hash(user_create.password)
+        # Hash the password (off the event loop)
+        hashed_password = await password_hasher.hash(user_create.password)
 
         # Create a new user in the database
-        await db.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)", (user_create.username, user_create.email, hashed_password))
-        await db.commit()
+        await db.create_user(user_create.username, user_create.email, hashed_password)
 
         # Return a redirect to the login page
         return RedirectResponse(url="/login", status_code=302)
+    except HTTPException:
+        raise
     except Exception as e:
         # Log the error and return a 500 response
         logger.error(f"Error creating user: {e}")
@@ -269,7 +267,7 @@ async def signup(user_create: UserCreate):
 @app.get("/")
 async def root(request: Request):
     """Serve the home page - redirect authenticated users to chat"""
-    user = getattr(request.state, 'user', None)
+    user = await get_request_user(request)
     if user:
         # Redirect authenticated users to chat
         return RedirectResponse(url="/chat", status_code=302)
@@ -278,7 +276,7 @@ async def root(request: Request):
 @app.get("/check-auth")
 async def check_auth(request: Request):
     """Check if user is authenticated and return user info"""
-    user = getattr(request.state, 'user', None)
+    user = await get_request_user(request)
     if user:
         return {"authenticated": True, "username": user.username}
     return {"authenticated": False}
@@ -288,7 +286,7 @@ async def check_auth(request: Request):
 @app.get("/about")
 async def about(request: Request):
     """Serve the about page - redirect authenticated users to chat"""
-    user = getattr(request.state, 'user', None)
+    user = await get_request_user(request)
     if user:
         # Redirect authenticated users to chat
         return RedirectResponse(url="/chat", status_code=302)
@@ -297,32 +295,12 @@ async def about(request: Request):
 @app.get("/friends")
 async def friends_page(request: Request):
     """Serve the friends page template - requires authentication"""
-    # First try to get user from middleware (for API requests with headers)
-    user = getattr(request.state, 'user', None)
+    # First try the Authorization header or auth cookie
+    user = await get_request_user(request)
     
-    # If no user from middleware, check for token in query params (for browser navigation)
+    # If no user yet, check for token in query params (for browser navigation)
     if not user:
-        token = request.query_params.get("token")
-        if token:
-            try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-                username = payload.get("sub")
-                if username:
-                    user = await get_user(db, username)
-            except JWTError:
-                pass
-    
-    # If still no user, check for token in cookies as fallback
-    if not user:
-        token = request.cookies.get("auth_token")
-        if token:
-            try:
-                payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-                username = payload.get("sub")
-                if username:
-                    user = await get_user(db, username)
-            except JWTError:
-                pass
+        user = await authenticate_token(request.query_params.get("token"))
     
     if not user:
         return RedirectResponse(url="/login", status_code=302)
@@ -334,25 +312,18 @@ async def friends_page(request: Request):
 async def get_friends(request: Request):
     """Get current user's friends list"""
     user = await get_current_user_from_request(request)
+    # Unread message counts come back with the friends list in the same query
     friends = await db.get_friends_list(user.id)
-    
-    # Add unread message counts for each friend
-    for friend in friends:
-        unread_count = await db.get_unread_message_count(user.id, friend["friend_id"])
-        friend["unread_count"] = unread_count
-    
     return {"friends": friends}
 
 @app.get("/api/conversation/{friend_id}")
-async def get_conversation(request: Request, friend_id: int):
-    """Get conversation history with a specific friend"""
+async def get_conversation(request: Request, friend_id: int, before_id: Optional[int] = None,
+                           after_id: Optional[int] = None, limit: int = CONVERSATION_PAGE_SIZE):
+    """Get a page of conversation history with a specific friend (newest first page, then before_id/after_id cursors)"""
     user = await get_current_user_from_request(request)
     
     # Verify they are friends
-    friends = await db.get_friends_list(user.id)
-    is_friend = any(friend["friend_id"] == friend_id for friend in friends)
-    
-    if not is_friend:
+    if not await db.are_friends(user.id, friend_id):
         raise HTTPException(status_code=403, detail="Can only view conversations with friends")
     
 
@@ -362,17 +333,18 @@ async def get_conversation(request: Request, friend_id: int):
         raise HTTPException(status_code=404, detail="User not found")
 
     # Get the conversation
-    conversation = await db.get_conversation(user.id, friend_id)
-    return {"conversation": conversation}
+    limit = max(1, min(limit, MAX_CONVERSATION_PAGE_SIZE))
+    return await db.get_conversation(user.id, friend_id, limit, before_id, after_id)
 
 @app.get("/api/conversation/{user_id}/anyone")
-async def get_conversation_with_anyone(request: Request, user_id: int):
-    """Get conversation history with any user (including former friends)"""
+async def get_conversation_with_anyone(request: Request, user_id: int, before_id: Optional[int] = None,
+                                       after_id: Optional[int] = None, limit: int = CONVERSATION_PAGE_SIZE):
+    """Get a page of conversation history with any user (including former friends)"""
     current_user = await get_current_user_from_request(request)
     
     # Allow viewing conversations with anyone (for chat history preservation)
-    conversation = await db.get_conversation_with_anyone(current_user.id, user_id)
-    return {"conversation": conversation}
+    limit = max(1, min(limit, MAX_CONVERSATION_PAGE_SIZE))
+    return await db.get_conversation_with_anyone(current_user.id, user_id, limit, before_id, after_id)
 
 @app.get("/api/recent-conversations")
 async def get_recent_conversations(request: Request):
@@ -382,22 +354,19 @@ async def get_recent_conversations(request: Request):
     return {"conversations": conversations}
 
 @app.post("/api/conversation/{friend_id}/mark-read")
-async def mark_conversation_read(request: Request, friend_id: int):
-    """Mark messages from a specific friend as read"""
+async def mark_conversation_read(request: Request, friend_id: int, message_id: Optional[int] = None):
+    """Mark messages from a specific friend as read, up to message_id or all of them"""
     user = await get_current_user_from_request(request)
     
     # Verify they are friends
-    friends = await db.get_friends_list(user.id)
-    is_friend = any(friend["friend_id"] == friend_id for friend in friends)
-    
-    if not is_friend:
+    if not await db.are_friends(user.id, friend_id):
         raise HTTPException(status_code=403, detail="Can only mark messages from friends as read")
     
-    success = await db.mark_messages_as_read(user.id, friend_id)
-    if success:
-        return {"message": "Messages marked as read"}
-    else:
-        raise HTTPException(status_code=500, detail="Failed to mark messages as read")
+    # Same path as WebSocket read receipts: the friend is told, and the cursor is stored before responding
+    latest_id = await db.get_latest_received_from(user.id, friend_id, message_id)
+    if latest_id is not None:
+        await read_receipts.submit(user.id, user.username, friend_id, latest_id)
+    return {"message": "Messages marked as read", "last_read_message_id": latest_id}
 
 @app.get("/api/friend-requests")
 async def get_friend_requests(request: Request):
@@ -440,6 +409,25 @@ async def get_current_user_info(request: Request):
         "email": user.email
     }
 
+@app.get("/api/metrics")
+async def get_metrics(request: Request):
+    """Get runtime metrics (database connection pool usage)"""
+    await get_current_user_from_request(request)
+    return {
+        "db_pool": db.pool_stats(),
+        "db_profile": await db.active_profile(),
+        "message_batcher": message_batcher.stats(),
+        "user_cache": db.user_cache.stats(),
+        "friend_graph": db.friend_graph.stats(),
+        "token_cache": verified_tokens.stats(),
+        "websockets": connections.stats(),
+        "presence": presence.stats(),
+        "typing": typing_throttle.stats(),
+        "read_receipts": read_receipts.stats(),
+        "password_hasher": password_hasher.stats(),
+        "bus": bus.stats(),
+    }
+
 
 @app.get("/api/friends/online-status")
 async def get_friends_online_status(request: Request):
@@ -453,7 +441,7 @@ async def get_friends_online_status(request: Request):
     online_status = []
     for friend in friends:
         friend_id = friend["friend_id"]
-        is_online = any(conn["user_id"] == friend_id for conn in connections)
+        is_online = presence.is_online(friend_id)
         
         online_status.append({
             "friend_id": friend_id,
@@ -480,13 +468,13 @@ async def send_friend_request(request: Request, friend_data: FriendRequestData):
             raise HTTPException(status_code=400, detail="Friend request already sent")
     
     # Check if already friends
-    friends = await db.get_friends_list(user.id)
-    for friend in friends:
-        if friend["friend_id"] == friend_data.friend_id:
-            raise HTTPException(status_code=400, detail="Already friends with this user")
+    if await db.are_friends(user.id, friend_data.friend_id):
+        raise HTTPException(status_code=400, detail="Already friends with this user")
     
     success = await db.send_friend_request(user.id, friend_data.friend_id)
     if success:
+        # A request crossing one from the other user is accepted right away
+        publish_friends_changed(user.id, friend_data.friend_id)
         # Get recipient user info for WebSocket notification
         recipient_user = await db.get_user_by_id(friend_data.friend_id)
         if recipient_user:
@@ -512,6 +500,7 @@ async def accept_friend_request(request: Request, friend_data: FriendRequestData
 
     success = await db.accept_friend_request(user.id, friend_data.friend_id)
     if success:
+        publish_friends_changed(user.id, friend_data.friend_id)
         sender_user = await db.get_user_by_id(friend_data.friend_id)
         if sender_user:
             await broadcast_friend_request_update(
@@ -547,6 +536,7 @@ async def remove_friend(request: Request, friend_id: int):
     user = await get_current_user_from_request(request)
     success = await db.remove_friend(user.id, friend_id)
     if success:
+        publish_friends_changed(user.id, friend_id)
         return {"message": "Friend removed successfully"}
     else:
         raise HTTPException(status_code=500, detail="Failed to remove friend")
@@ -606,41 +596,59 @@ async def websocket_endpoint(websocket: WebSocket):
             return
             
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            username = payload.get("sub")
-            if not username:
-                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-                return
-                
-            user = await get_user(db, username)
+            user = await authenticate_token(token)
             if not user:
                 await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
                 return
                 
-            await websocket.accept()
+            # Clients that offer the MessagePack subprotocol get binary frames, everyone else JSON text
+            subprotocol = select_subprotocol(websocket.scope.get("subprotocols", []))
+            binary = subprotocol is not None
+            await websocket.accept(subprotocol=subprotocol)
+            
+            try:
+                protocol_version = max(1, min(int(websocket.query_params.get("v", 1)), PROTOCOL_VERSION))
+            except ValueError:
+                protocol_version = 1
+            
+            # A reconnecting client passes the last message id it received
+            try:
+                resume_after = int(websocket.query_params["since"]) if "since" in websocket.query_params else None
+            except ValueError:
+                resume_after = None
             
             # Store connection with user info
-            user_connection = {"websocket": websocket, "user_id": user.id, "username": user.username}
-            connections.append(user_connection)
+            user_connection = connections.add(websocket, user.id, user.username, binary, protocol_version)
+            
+            # Anything newer than this is delivered live, since the connection is already registered
+            last_message_id = await db.get_last_received_message_id(user.id)
             
             # Send initial connection confirmation
-            await websocket.send_text(json.dumps({
+            user_connection.send(Frame({
                 "type": "connection_established",
                 "user_id": user.id,
                 "username": user.username,
+                "protocol_version": protocol_version,
+                "last_message_id": last_message_id,
                 "timestamp": datetime.now().isoformat()
             }))
             
-            # Notify other users that this user is now online
-            await broadcast_user_status_update(user.id, user.username, "online")
+            # Notify friends if this is the user's first open connection
+            presence.connected(user.id, user.username)
+            
+            if resume_after is not None:
+                await resume_missed_messages(user_connection, user, resume_after, last_message_id)
             
             try:
                 while True:
-                    data = await websocket.receive_text()
+                    if binary:
+                        data = await websocket.receive_bytes()
+                    else:
+                        data = await websocket.receive_text()
                     
                     try:
                         # Parse the message data
-                        message_data = json.loads(data)
+                        message_data = decode_binary(data) if binary else decode_frame(data)
                         
                         # Handle different message types
                         if message_data.get("type") == "message" or (message_data.get("text") and message_data.get("recipient")):
@@ -648,6 +656,10 @@ async def websocket_endpoint(websocket: WebSocket):
                             message_text = message_data.get("text", "")
                             recipient_username = message_data.get("recipient", "")
                             
+                            # MessagePack can carry bin/int values where JSON only ever gave strings
+                            if not isinstance(message_text, str) or not isinstance(recipient_username, str):
+                                continue
+
                             if not message_text or not recipient_username:
                                 continue
                             
@@ -657,14 +669,23 @@ async def websocket_endpoint(websocket: WebSocket):
                                 continue
                             
                             # Verify they are friends
-                            friends = await db.get_friends_list(user.id)
-                            is_friend = any(friend["friend_id"] == recipient_user.id for friend in friends)
-                            
-                            if not is_friend:
+                            if not await db.are_friends(user.id, recipient_user.id):
                                 continue
                             
-                            # Save message to database
-                            conversation_id = await db.save_message(user.id, recipient_user.id, message_text)
+                            # Optional client-generated id; a retransmit with the same id is stored once
+                            client_message_id = message_data.get("client_message_id")
+                            if not isinstance(client_message_id, str) or not 0 < len(client_message_id) <= MAX_CLIENT_MESSAGE_ID_LENGTH:
+                                client_message_id = None
+                            
+                            # Save message to database (group-committed with other sessions' messages)
+                            try:
+                                message_id, timestamp, created = await message_batcher.submit(
+                                    user.id, recipient_user.id, message_text, client_message_id
+                                )
+                            except Exception as e:
+                                print(f"Error saving message: {e}")
+                                continue
+                            conversation_id = db.conversation_id_for(user.id, recipient_user.id)
                             
                             # Create message object to send
                             message_to_send = {
@@ -674,126 +695,80 @@ async def websocket_endpoint(websocket: WebSocket):
                                 "recipient_id": recipient_user.id,
                                 "recipient_username": recipient_username,
                                 "message_text": message_text,
-                                "timestamp": datetime.now().isoformat(),
-                                "message_id": conversation_id,
+                                "timestamp": timestamp,
+                                "message_id": message_id,
                                 "conversation_id": conversation_id
                             }
                             
-                            # Send to recipient if they're online
-                            connections_copy = connections.copy()
-                            broken_connections = []
+                            notification = {
+                                "notification_type": "new_message",
+                                "message_preview": message_text[:50] + "..." if len(message_text) > 50 else message_text
+                            }
                             
-                            for conn in connections_copy:
-                                if conn["user_id"] == recipient_user.id:
-                                    try:
-                                        await conn["websocket"].send_text(json.dumps(message_to_send))
-                                        
-                                        # Also send a notification update
-                                        await conn["websocket"].send_text(json.dumps({
-                                            "type": "notification_update",
-                                            "notification_type": "new_message",
-                                            "sender_username": user.username,
-                                            "sender_id": user.id,
-                                            "recipient_id": recipient_user.id,
-                                            "conversation_id": conversation_id,
-                                            "message_preview": message_text[:50] + "..." if len(message_text) > 50 else message_text,
-                                            "timestamp": message_to_send["timestamp"]
-                                        }))
-                                    except:
-                                        # Mark for removal
-                                        broken_connections.append(conn)
+                            # Protocol 2 clients get one combined frame, older ones the message plus a notification update
+                            combined_payload = {**message_to_send, **notification}
+                            notification_payload = {
+                                "type": "notification_update",
+                                **notification,
+                                "sender_username": user.username,
+                                "sender_id": user.id,
+                                "recipient_id": recipient_user.id,
+                                "conversation_id": conversation_id,
+                                "timestamp": message_to_send["timestamp"]
+                            }
                             
-                            # Remove broken connections
-                            for broken_conn in broken_connections:
-                                if broken_conn in connections:
-                                    connections.remove(broken_conn)
+                            # Send to recipient on whichever worker holds their sockets; a
+                            # retransmitted message was delivered the first time around
+                            if created:
+                                deliver([recipient_user.id], combined_payload, [message_to_send, notification_payload])
                             
                             # Send confirmation back to sender
                             confirmation = {
                                 "type": "message_sent",
                                 "message_id": message_to_send["message_id"],
+                                "client_message_id": client_message_id,
+                                "conversation_id": conversation_id,
                                 "timestamp": message_to_send["timestamp"]
                             }
-                            await websocket.send_text(json.dumps(confirmation))
+                            user_connection.send(Frame(confirmation))
                             
                         elif message_data.get("type") == "typing_indicator":
                             # Handle typing indicator
                             recipient_username = message_data.get("recipient", "")
                             is_typing = message_data.get("is_typing", False)
                             
-                            if recipient_username:
-                                recipient_user = await get_user(db, recipient_username)
-                                if recipient_user:
-                                    # Send typing indicator to recipient
-                                    typing_message = {
-                                        "type": "typing_indicator",
-                                        "username": user.username,
-                                        "is_typing": is_typing,
-                                        "timestamp": datetime.now().isoformat()
-                                    }
-                                    
-                                    connections_copy = connections.copy()
-                                    broken_connections = []
-                                    
-                                    for conn in connections_copy:
-                                        if conn["user_id"] == recipient_user.id:
-                                            try:
-                                                await conn["websocket"].send_text(json.dumps(typing_message))
-                                            except:
-                                                broken_connections.append(conn)
-                                    
-                                    # Remove broken connections
-                                    for broken_conn in broken_connections:
-                                        if broken_conn in connections:
-                                            connections.remove(broken_conn)
+                            # Only online recipients can see it, so resolve them from presence
+                            recipient_id = presence.user_id_for(recipient_username) if recipient_username else None
+                            if recipient_id is not None:
+                                typing_throttle.update(user.id, user.username, recipient_id, bool(is_typing))
                                                 
                         elif message_data.get("type") == "read_receipt":
                             # Handle read receipt
                             message_id = message_data.get("message_id", "")
                             
-                            if message_id:
-                                # Find the sender of the original message
-                                # For now, we'll broadcast to all connections
-                                # In a real app, you'd store message ownership in the database
-                                read_receipt = {
-                                    "type": "read_receipt",
-                                    "message_id": message_id,
-                                    "read_by": user.username,
-                                    "timestamp": datetime.now().isoformat()
-                                }
-                                
-                                # Send to all connections (in a real app, you'd send only to the message sender)
-                                connections_copy = connections.copy()
-                                broken_connections = []
-                                
-                                for conn in connections_copy:
-                                    try:
-                                        await conn["websocket"].send_text(json.dumps(read_receipt))
-                                    except:
-                                        broken_connections.append(conn)
-                                
-                                # Remove broken connections
-                                for broken_conn in broken_connections:
-                                    if broken_conn in connections:
-                                        connections.remove(broken_conn)
+                            try:
+                                participants = await db.get_message_participants(int(message_id)) if message_id else None
+                            except (TypeError, ValueError):
+                                participants = None
+                            
+                            # Only the recipient of a message can mark it read; receipts are
+                            # coalesced per conversation and only its sender is told
+                            if participants and participants[1] == user.id:
+                                read_receipts.submit(user.id, user.username, participants[0], int(message_id))
                         
-                    except json.JSONDecodeError:
-                        # Handle non-JSON messages (fallback)
+                    except ValueError:
+                        # Ignore frames that are not valid JSON / MessagePack
                         continue
                         
             except Exception as e:
                 print(f"WebSocket error for user {user.username}: {e}")
-                # Remove connection safely
-                if user_connection in connections:
-                    connections.remove(user_connection)
-                # Notify other users that this user is now offline
-                await broadcast_user_status_update(user.id, user.username, "offline")
             finally:
                 # Always clean up connection when WebSocket closes
-                if user_connection in connections:
-                    connections.remove(user_connection)
-                # Notify other users that this user is now offline
-                await broadcast_user_status_update(user.id, user.username, "offline")
+                connections.remove(user_connection)
+                if not connections.is_online(user.id):
+                    typing_throttle.clear_sender(user.id)
+                # Notify friends once the user's last connection has been gone for the grace period
+                presence.disconnected(user.id, user.username)
                 
         except JWTError:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
@@ -802,31 +777,109 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
 
 
-async def broadcast_user_status_update(user_id: int, username: str, status: str):
-    """Broadcast user status updates to all connected clients"""
-    status_message = {
-        "type": "user_status_update",
-        "user_id": user_id,
-        "username": username,
-        "status": status,
+async def resume_missed_messages(user_connection: Connection, user, after_id: int, until_id: int):
+    """Replay the messages a reconnecting client missed, RESUME_BATCH_SIZE per frame"""
+    replayed = 0
+    while after_id < until_id and replayed < RESUME_MAX_MESSAGES:
+        batch = await db.get_messages_since(user.id, after_id, min(RESUME_BATCH_SIZE, RESUME_MAX_MESSAGES - replayed))
+        batch = [message for message in batch if message["message_id"] <= until_id]
+        if not batch:
+            break
+        for message in batch:
+            message["recipient_id"] = user.id
+            message["recipient_username"] = user.username
+        after_id = batch[-1]["message_id"]
+        replayed += len(batch)
+        user_connection.send(Frame({"type": "missed_messages", "messages": batch}))
+    
+    # complete is False when the client has to reload its conversations to catch up
+    user_connection.send(Frame({
+        "type": "resume_complete",
+        "last_message_id": after_id,
+        "replayed": replayed,
+        "complete": after_id >= until_id,
+        "timestamp": datetime.now().isoformat()
+    }))
+
+
+def deliver(user_ids: List[int], payload: dict, legacy_payloads: Optional[List[dict]] = None, droppable: bool = False):
+    """Send a frame to every socket of these users, on whichever worker holds them
+
+    Connections below protocol version 2 get legacy_payloads instead, when given.
+    """
+    bus.publish({
+        "kind": "deliver",
+        "user_ids": list(user_ids),
+        "payload": payload,
+        "legacy": legacy_payloads,
+        "droppable": droppable,
+    })
+
+
+def publish_friends_changed(*user_ids: int):
+    """Tell the other workers to reload these users' friends"""
+    bus.publish({"kind": "friends_changed", "user_ids": list(user_ids)})
+
+
+def handle_bus_event(event: dict):
+    """Apply deliveries and friendship changes published by any worker, this one included"""
+    kind = event.get("kind")
+    if kind == "deliver":
+        targets = connections.connections_for_users(event["user_ids"])
+        if targets:
+            send_to_connections(targets, Frame(event["payload"]), event.get("droppable", False), event.get("legacy"))
+    elif kind == "friends_changed" and event["worker"] != bus.worker_id:
+        # This worker's friend graph was updated in place already
+        db.friend_graph.invalidate(*event["user_ids"])
+
+
+bus.subscribe(handle_bus_event)
+
+
+def send_to_connections(targets: List[Connection], frame: Frame, droppable: bool = False, legacy_payloads: Optional[List[dict]] = None):
+    """Queue a frame on each connection; every connection's writer task does the actual send"""
+    legacy_frames = [Frame(payload) for payload in legacy_payloads] if legacy_payloads else None
+    for conn in targets:
+        if legacy_frames is not None and conn.protocol_version < 2:
+            for legacy_frame in legacy_frames:
+                conn.send(legacy_frame, droppable)
+        else:
+            conn.send(frame, droppable)
+
+
+def forward_typing_indicator(sender_id: int, sender_username: str, recipient_id: int, is_typing: bool):
+    """Send a throttled typing state change to the recipient"""
+    typing_message = {
+        "type": "typing_indicator",
+        "username": sender_username,
+        "is_typing": is_typing,
         "timestamp": datetime.now().isoformat()
     }
     
-    # Create a copy of connections to avoid modification during iteration
-    connections_copy = connections.copy()
-    broken_connections = []
-    
-    for conn in connections_copy:
-        try:
-            await conn["websocket"].send_text(json.dumps(status_message))
-        except:
-            # Mark for removal
-            broken_connections.append(conn)
+    # Typing indicators are the first frames dropped for a slow client
+    deliver([recipient_id], typing_message, droppable=True)
+
+
+# Keystroke-rate typing events, coalesced per sender and recipient
+typing_throttle = TypingThrottle(forward_typing_indicator)
+
+
+def forward_read_receipt(reader_id: int, reader_username: str, sender_id: int, message_id: int):
+    """Tell the sender that the reader has read their messages up to message_id"""
+    read_receipt = {
+        "type": "read_receipt",
+        "message_id": message_id,
+        "read_by": reader_username,
+        "reader_id": reader_id,
+        "conversation_id": db.conversation_id_for(reader_id, sender_id),
+        "timestamp": datetime.now().isoformat()
+    }
     
-    # Remove broken connections
-    for broken_conn in broken_connections:
-        if broken_conn in connections:
-            connections.remove(broken_conn)
+    deliver([sender_id], read_receipt)
+
+
+# Read receipts, stored as one cursor per conversation and coalesced per tick
+read_receipts = ReadReceiptBatcher(db.advance_read_cursors, forward_read_receipt)
 
 
 async def broadcast_friend_request_update(sender_id: int, sender_username: str, recipient_id: int, recipient_username: str, request_type: str):
@@ -842,20 +895,7 @@ async def broadcast_friend_request_update(sender_id: int, sender_username: str,
     }
     
     # Send to both sender and recipient if they're online
-    connections_copy = connections.copy()
-    broken_connections = []
-    
-    for conn in connections_copy:
-        if conn["user_id"] in [sender_id, recipient_id]:
-            try:
-                await conn["websocket"].send_text(json.dumps(request_message))
-            except:
-                broken_connections.append(conn)
-    
-    # Remove broken connections
-    for broken_conn in broken_connections:
-        if broken_conn in connections:
-            connections.remove(broken_conn)
+    deliver([sender_id, recipient_id], request_message)
 
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
@@ -864,6 +904,15 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 async def get_user(db, username: str):
     return await db.get_user_by_username(username)
 
+async def authenticate_token(token: Optional[str]):
+    """Resolve a JWT to its user, or None if the token is missing, invalid or expired"""
+    if not token:
+        return None
+    username = verify_token(token)
+    if not username:
+        return None
+    return await get_user(db, username)
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -877,7 +926,7 @@ async def authenticate_user(db, username: str, password: str):
     user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    if not await password_hasher.verify(password, user.password):
         return False
     return user
 
@@ -907,51 +956,6 @@ async def login_for_access_token(login_data: LoginData):
     }
 
 
-@app.middleware("http")
-async def verify_token(request: Request, call_next):
-    print("Middleware executed")
-    print(f"Request path: {request.url.path}")
-    print(f"Authorization header: {request.headers.get('Authorization')}")
-    print(f"Cookies: {request.cookies}")
-    
-    try:
-        # First try to get token from Authorization header
-        token = request.headers.get("Authorization")
-        if token:
-            token = token.replace("Bearer ", "")  # Remove the Bearer prefix
-        else:
-            # Fallback to cookie-based authentication
-            token = request.cookies.get("auth_token")
-        
-        if not token:
-            # Set a default user for unauthenticated requests
-            request.state.user = None
-            print("No token found in headers or cookies")
-            return await call_next(request)
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            username = payload.get("sub")
-            if username:
-                # Get user from database and set it on request
-                user = await get_user(db, username)
-                if user:
-                    request.state.user = user
-                    print(f"User authenticated: {user.username}")
-                else:
-                    request.state.user = None
-                    print("User not found in database")
-            else:
-                request.state.user = None
-                print("No username in token payload")
-        except JWTError as e:
-            print("Error decoding token:", e)
-            request.state.user = None
-    except Exception as e:
-        print("Error:", e)
-        request.state.user = None
-    
-    return await call_next(request)
-
 @app.post("/logout")
 async def logout_user(response: Response):
     """Logout user by clearing the auth cookie"""
@@ -967,7 +971,7 @@ async def logout_user(response: Response):
 async def get_ws_token(request: Request):
     """Get a token for WebSocket authentication"""
     # Get user from cookie authentication
-    user = getattr(request.state, 'user', None)
+    user = await get_request_user(request)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,3 +1,14 @@
+// /ws frame layout this client understands (see PROTOCOL_VERSION in main.py)
+const PROTOCOL_VERSION = 2;
+
+// Id sent with each chat message so the server stores a retransmitted copy only once
+function newClientMessageId(): string {
+  if (typeof crypto.randomUUID === "function") {
+    return crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
 interface ChatMessage {
   text: string;
   timestamp: string;
@@ -50,7 +61,20 @@ class ChatApp {
   private typingIndicators: Map<string, TypingIndicator> = new Map();
   private typingTimeout: NodeJS.Timeout | null = null;
   private lastTypingTime: number = 0;
-  private pendingReadReceipts: Set<string> = new Set();
+  // Sent message id -> conversation id, until the friend has read it
+  private pendingReadReceipts: Map<string, string> = new Map();
+
+  // Conversation history paging
+  private hasOlderMessages: Map<number, boolean> = new Map();
+  private loadingOlderMessages: boolean = false;
+
+  // Newest message id received over /ws; sent as ?since= on reconnect so the
+  // server replays only the messages missed while disconnected
+  private lastMessageId: number | null = null;
+
+  // Chat frames not yet confirmed by message_sent, keyed by client_message_id;
+  // they are sent again after a reconnect
+  private unacknowledgedMessages: Map<string, any> = new Map();
 
   // Current user info
   private currentUserId: number | null = null;
@@ -456,29 +480,16 @@ class ChatApp {
 
   private async loadConversationFromServer(friendId: number): Promise<void> {
     try {
-      // Try to load conversation with current friend first
-      let response = await fetch(`/api/conversation/${friendId}`);
+      const data = await this.fetchConversationPage(friendId);
 
-      // If that fails (e.g., they're no longer a friend), try the "anyone" endpoint
-      if (!response.ok && response.status === 403) {
-        console.log(
-          "User is no longer a friend, trying to load conversation history anyway..."
+      if (data) {
+        const messages = data.conversation.map((msg: any) =>
+          this.toChatMessage(msg)
         );
-        response = await fetch(`/api/conversation/${friendId}/anyone`);
-      }
-
-      if (response.ok) {
-        const data = await response.json();
-        const messages = data.conversation.map((msg: any) => ({
-          text: msg.message_text,
-          timestamp: msg.timestamp,
-          sender: msg.sender_username,
-          messageId: msg.id.toString(),
-          isRead: msg.is_read,
-        }));
 
         // Store in memory
         this.conversations.set(friendId, messages);
+        this.hasOlderMessages.set(friendId, data.has_more);
 
         // Show messages
         if (this.noMessagesElement && this.messagesContainer) {
@@ -497,6 +508,87 @@ class ChatApp {
     }
   }
 
+  private async fetchConversationPage(
+    friendId: number,
+    beforeId?: string
+  ): Promise<any | null> {
+    const query = beforeId ? `?before_id=${encodeURIComponent(beforeId)}` : "";
+
+    // Try to load conversation with current friend first
+    let response = await fetch(`/api/conversation/${friendId}${query}`);
+
+    // If that fails (e.g., they're no longer a friend), try the "anyone" endpoint
+    if (!response.ok && response.status === 403) {
+      console.log(
+        "User is no longer a friend, trying to load conversation history anyway..."
+      );
+      response = await fetch(`/api/conversation/${friendId}/anyone${query}`);
+    }
+
+    return response.ok ? await response.json() : null;
+  }
+
+  private toChatMessage(msg: any): ChatMessage {
+    return {
+      text: msg.message_text,
+      timestamp: msg.timestamp,
+      sender: msg.sender_username,
+      messageId: msg.id.toString(),
+      isRead: msg.is_read,
+    };
+  }
+
+  private async loadOlderMessages(): Promise<void> {
+    if (!this.selectedFriend || this.loadingOlderMessages) return;
+
+    const friendId = this.selectedFriend.friend_id;
+    const messages = this.conversations.get(friendId) || [];
+    if (!this.hasOlderMessages.get(friendId) || messages.length === 0) return;
+
+    this.loadingOlderMessages = true;
+    try {
+      // Page back from the oldest message we already have
+      const data = await this.fetchConversationPage(
+        friendId,
+        messages[0].messageId
+      );
+      if (!data) return;
+
+      const olderMessages: ChatMessage[] = data.conversation.map((msg: any) =>
+        this.toChatMessage(msg)
+      );
+      this.hasOlderMessages.set(friendId, data.has_more);
+      this.conversations.set(friendId, [
+        ...olderMessages,
+        ...(this.conversations.get(friendId) || []),
+      ]);
+
+      if (
+        !this.messagesContainer ||
+        this.selectedFriend?.friend_id !== friendId
+      ) {
+        return;
+      }
+
+      // Prepend the older messages while keeping the visible ones in place
+      const previousHeight = this.messagesContainer.scrollHeight;
+      const fragment = document.createDocumentFragment();
+      olderMessages.forEach((message) => {
+        fragment.appendChild(this.createMessageElement(message));
+      });
+      this.messagesContainer.insertBefore(
+        fragment,
+        this.messagesContainer.firstChild
+      );
+      this.messagesContainer.scrollTop +=
+        this.messagesContainer.scrollHeight - previousHeight;
+    } catch (error) {
+      console.error("Error loading older messages:", error);
+    } finally {
+      this.loadingOlderMessages = false;
+    }
+  }
+
   private displayMessages(messages: ChatMessage[]): void {
     if (!this.messagesContainer) return;
 
@@ -567,6 +659,13 @@ class ChatApp {
       this.sendMessage();
     });
 
+    // Load older messages when scrolled to the top of the conversation
+    this.messagesContainer?.addEventListener("scroll", () => {
+      if (this.messagesContainer && this.messagesContainer.scrollTop < 50) {
+        this.loadOlderMessages();
+      }
+    });
+
     // Typing indicator
     this.messageInput?.addEventListener("input", () => {
       this.handleTyping();
@@ -760,12 +859,13 @@ class ChatApp {
     const messageText = this.messageInput.value.trim();
     if (!messageText) return;
 
-    // Create message object
+    // Create message object; it carries the client id until the server confirms it
+    const clientMessageId = newClientMessageId();
     const message: ChatMessage = {
       text: messageText,
       timestamp: new Date().toISOString(),
       sender: "You",
-      messageId: `msg_${Date.now()}`,
+      messageId: clientMessageId,
       isRead: false,
     };
 
@@ -782,12 +882,14 @@ class ChatApp {
     this.messageInput.value = "";
 
     // Send via WebSocket
-    if (this.ws) {
-      const messageData = {
-        type: "message",
-        text: messageText,
-        recipient: this.selectedFriend.username,
-      };
+    const messageData = {
+      type: "message",
+      text: messageText,
+      recipient: this.selectedFriend.username,
+      client_message_id: clientMessageId,
+    };
+    this.unacknowledgedMessages.set(clientMessageId, messageData);
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
       this.ws.send(JSON.stringify(messageData));
     }
 
@@ -808,10 +910,15 @@ class ChatApp {
       const tokenData = await tokenResponse.json();
       const token = tokenData.token;
 
-      // Connect to WebSocket with token as query parameter
+      // Connect to WebSocket with token as query parameter; v=2 asks for
+      // chat messages that carry their notification fields in the same frame
       const wsProtocol = window.location.protocol === "https:" ? "wss:" : "ws:";
       const wsHost = window.location.host;
-      this.ws = new WebSocket(`${wsProtocol}//${wsHost}/ws?token=${token}`);
+      const since =
+        this.lastMessageId !== null ? `&since=${this.lastMessageId}` : "";
+      this.ws = new WebSocket(
+        `${wsProtocol}//${wsHost}/ws?token=${token}&v=${PROTOCOL_VERSION}${since}`
+      );
 
       this.setupWebSocketEventHandlers();
     } catch (error) {
@@ -829,71 +936,38 @@ class ChatApp {
     this.ws.onopen = () => {
       console.log("WebSocket connected");
       this.updateConnectionStatus("Connected", "bg-green-100 text-green-700");
+
+      // Messages that may have been lost with the previous connection; the
+      // server recognises their client ids and does not store them twice
+      this.unacknowledgedMessages.forEach((messageData) =>
+        this.ws?.send(JSON.stringify(messageData))
+      );
     };
 
     this.ws.onmessage = (event: MessageEvent) => {
-      if (!this.messagesContainer || !this.noMessagesElement) return;
-
       try {
         // Parse the message data
         const messageData = JSON.parse(event.data);
 
         if (messageData.type === "message") {
-          // This is a chat message
-          const message: ChatMessage = {
-            text: messageData.message_text,
-            timestamp: messageData.timestamp,
-            sender: messageData.sender_username,
-            messageId: messageData.message_id || `msg_${Date.now()}`,
-            isRead: false,
-          };
-
-          // Add to conversation if it's from the currently selected friend
-          if (
-            this.selectedFriend &&
-            (messageData.sender_username === this.selectedFriend.username ||
-              messageData.recipient_username === this.selectedFriend.username)
-          ) {
-            // Hide no messages state
-            this.noMessagesElement.classList.add("hidden");
-            this.messagesContainer.classList.remove("hidden");
-
-            // Add message to conversation
-            const conversation =
-              this.conversations.get(this.selectedFriend.friend_id) || [];
-            conversation.push(message);
-            this.conversations.set(this.selectedFriend.friend_id, conversation);
-
-            // Display the message
-            const messageElement = this.createMessageElement(message);
-            this.messagesContainer.appendChild(messageElement);
-            this.messagesContainer.scrollTop =
-              this.messagesContainer.scrollHeight;
-
-            // Clear typing indicator since message was sent
-            this.clearTypingIndicator(messageData.sender_username);
-            // Also clear typing indicator in conversations list
-            this.updateConversationTypingIndicator(
-              messageData.sender_username,
-              false
-            );
-
-            // Send read receipt
-            this.sendReadReceipt(messageData.message_id || message.messageId);
-          } else {
-            // Message from someone else - update unread count
-            this.updateUnreadCountForFriend(messageData.sender_username);
-          }
-
-          // Always refresh the conversations list to show new messages in real-time
-          this.loadUnifiedConversations();
+          this.handleChatMessage(messageData);
         } else if (messageData.type === "message_sent") {
           // This is a confirmation that our message was sent
           console.log("Message sent successfully:", messageData);
 
+          if (messageData.client_message_id) {
+            this.acknowledgeMessage(
+              messageData.client_message_id,
+              messageData.message_id
+            );
+          }
+
           // Add message to local conversation with pending read receipt
           if (this.selectedFriend && messageData.message_id) {
-            this.pendingReadReceipts.add(messageData.message_id);
+            this.pendingReadReceipts.set(
+              String(messageData.message_id),
+              messageData.conversation_id
+            );
           }
         } else if (messageData.type === "typing_indicator") {
           // Handle typing indicator
@@ -906,24 +980,41 @@ class ChatApp {
             "WebSocket connection established for user:",
             messageData.username
           );
+          // On the first connection start the replay cursor at the newest message
+          if (this.lastMessageId === null) {
+            this.lastMessageId = messageData.last_message_id ?? 0;
+          }
+        } else if (messageData.type === "missed_messages") {
+          // A batch of messages received while this client was disconnected
+          messageData.messages.forEach((message: any) =>
+            this.handleChatMessage({ type: "message", ...message }, false)
+          );
+          this.loadUnifiedConversations();
+        } else if (messageData.type === "resume_complete") {
+          if (!messageData.complete) {
+            // Too much was missed to replay; reload conversations over HTTP instead
+            this.conversations.clear();
+            this.loadUnifiedConversations();
+            if (this.selectedFriend) {
+              this.loadConversationFromServer(this.selectedFriend.friend_id);
+            }
+          }
+          this.lastMessageId = Math.max(
+            this.lastMessageId ?? 0,
+            messageData.last_message_id
+          );
         } else if (messageData.type === "user_status_update") {
           // Handle user status updates (online/offline)
           this.handleUserStatusUpdate(messageData);
+        } else if (messageData.type === "user_status_batch") {
+          // Several presence changes coalesced by the server into one frame
+          messageData.updates.forEach((update: any) =>
+            this.handleUserStatusUpdate(update)
+          );
         } else if (messageData.type === "notification_update") {
           // Handle notification updates (like new messages from other users)
           if (messageData.notification_type === "new_message") {
-            // Check if this message is for the currently open conversation
-            const currentConversationId = this.getCurrentConversationId();
-            const isForOpenConversation =
-              currentConversationId &&
-              messageData.conversation_id === currentConversationId;
-
-            if (!isForOpenConversation) {
-              // Show notification for new message
-              this.showNotification(
-                `New message from ${messageData.sender_username}: ${messageData.message_preview}`
-              );
-            }
+            this.handleNewMessageNotification(messageData);
           }
         }
       } catch (error) {
@@ -950,6 +1041,98 @@ class ChatApp {
     };
   }
 
+  private acknowledgeMessage(clientMessageId: string, messageId: number): void {
+    this.unacknowledgedMessages.delete(clientMessageId);
+
+    // Swap the temporary id of the local copy for the stored message id
+    this.conversations.forEach((conversation) => {
+      const message = conversation.find(
+        (existing) => existing.messageId === clientMessageId
+      );
+      if (message) {
+        message.messageId = String(messageId);
+      }
+    });
+  }
+
+  private handleChatMessage(
+    messageData: any,
+    refreshConversations: boolean = true
+  ): void {
+    if (!this.messagesContainer || !this.noMessagesElement) return;
+
+    // This is a chat message
+    const message: ChatMessage = {
+      text: messageData.message_text,
+      timestamp: messageData.timestamp,
+      sender: messageData.sender_username,
+      messageId: messageData.message_id || `msg_${Date.now()}`,
+      isRead: false,
+    };
+
+    if (typeof messageData.message_id === "number") {
+      this.lastMessageId = Math.max(
+        this.lastMessageId ?? 0,
+        messageData.message_id
+      );
+    }
+
+    // Add to conversation if it's from the currently selected friend
+    if (
+      this.selectedFriend &&
+      (messageData.sender_username === this.selectedFriend.username ||
+        messageData.recipient_username === this.selectedFriend.username)
+    ) {
+      // Hide no messages state
+      this.noMessagesElement.classList.add("hidden");
+      this.messagesContainer.classList.remove("hidden");
+
+      // Add message to conversation; a replayed message may already be shown
+      const conversation =
+        this.conversations.get(this.selectedFriend.friend_id) || [];
+      if (
+        conversation.some(
+          (existing) =>
+            String(existing.messageId) === String(message.messageId)
+        )
+      ) {
+        return;
+      }
+      conversation.push(message);
+      this.conversations.set(this.selectedFriend.friend_id, conversation);
+
+      // Display the message
+      const messageElement = this.createMessageElement(message);
+      this.messagesContainer.appendChild(messageElement);
+      this.messagesContainer.scrollTop =
+        this.messagesContainer.scrollHeight;
+
+      // Clear typing indicator since message was sent
+      this.clearTypingIndicator(messageData.sender_username);
+      // Also clear typing indicator in conversations list
+      this.updateConversationTypingIndicator(
+        messageData.sender_username,
+        false
+      );
+
+      // Send read receipt
+      this.sendReadReceipt(messageData.message_id || message.messageId);
+    } else {
+      // Message from someone else - update unread count
+      this.updateUnreadCountForFriend(messageData.sender_username);
+    }
+
+    // Always refresh the conversations list to show new messages in real-time
+    if (refreshConversations) {
+      this.loadUnifiedConversations();
+    }
+
+    // Protocol 2 folds the notification update into the message frame
+    if (messageData.notification_type === "new_message") {
+      this.handleNewMessageNotification(messageData);
+    }
+  }
+
   private updateConnectionStatus(status: string, classNames: string): void {
     if (!this.connectionStatusElement) return;
     const el = this.connectionStatusElement;
@@ -990,13 +1173,18 @@ class ChatApp {
   }
 
   private handleReadReceipt(data: any): void {
-    // Handle read receipts for messages
-    if (this.pendingReadReceipts.has(data.message_id)) {
-      this.pendingReadReceipts.delete(data.message_id);
-
-      // Update message display to show as read
-      this.updateMessageReadStatus(data.message_id, true);
-    }
+    // A receipt covers every message of the conversation up to message_id
+    this.pendingReadReceipts.forEach((conversationId, messageId) => {
+      if (
+        conversationId === data.conversation_id &&
+        Number(messageId) <= data.message_id
+      ) {
+        this.pendingReadReceipts.delete(messageId);
+
+        // Update message display to show as read
+        this.updateMessageReadStatus(messageId, true);
+      }
+    });
   }
 
   private sendReadReceipt(messageId: string): void {
@@ -1059,6 +1247,20 @@ class ChatApp {
     }
   }
 
+  private handleNewMessageNotification(data: any): void {
+    // Check if this message is for the currently open conversation
+    const currentConversationId = this.getCurrentConversationId();
+    const isForOpenConversation =
+      currentConversationId && data.conversation_id === currentConversationId;
+
+    if (!isForOpenConversation) {
+      // Show notification for new message
+      this.showNotification(
+        `New message from ${data.sender_username}: ${data.message_preview}`
+      );
+    }
+  }
+
   private handleUserStatusUpdate(data: any): void {
     // Update status indicators in conversations list
     const username = data.username;
@@ -838,6 +838,13 @@ class FriendsManager {
         this.updateUserStatus(message.user_id, message.status);
         break;
 
+      case "user_status_batch":
+        // Several presence changes coalesced by the server into one frame
+        message.updates.forEach((update: any) =>
+          this.updateUserStatus(update.user_id, update.status)
+        );
+        break;
+
       default:
         // Ignore other message types (like chat messages)
         break;
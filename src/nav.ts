@@ -2,6 +2,15 @@ interface User {
   username: string;
 }
 
+// /ws frame layout this client understands (see PROTOCOL_VERSION in main.py)
+const PROTOCOL_VERSION = 2;
+
+interface UserStatusUpdate {
+  user_id: number;
+  username: string;
+  status: string;
+}
+
 interface NotificationData {
   type: string;
   notification_type?: string;
@@ -17,6 +26,8 @@ interface NotificationData {
   // User status specific fields
   username?: string;
   status?: string;
+  // Presence changes coalesced into one user_status_batch frame
+  updates?: UserStatusUpdate[];
 }
 
 class NavigationManager {
@@ -233,7 +244,9 @@ class NavigationManager {
       // Connect to WebSocket with token as query parameter
       const proto = window.location.protocol === "https:" ? "wss" : "ws";
       const host = window.location.host;
-      this.ws = new WebSocket(`${proto}://${host}/ws?token=${token}`);
+      this.ws = new WebSocket(
+        `${proto}://${host}/ws?token=${token}&v=${PROTOCOL_VERSION}`
+      );
 
       this.ws.onopen = () => {
         console.log("Navigation WebSocket connected");
@@ -262,27 +275,12 @@ class NavigationManager {
 
   private handleWebSocketMessage(data: NotificationData): void {
     switch (data.type) {
+      // Protocol 2 delivers chat messages with their notification fields;
+      // protocol 1 sends a separate notification_update
+      case "message":
       case "notification_update":
         if (data.notification_type === "new_message") {
-          // Check if this message is for the currently open conversation
-          const currentPath = window.location.pathname;
-          const isInChat = currentPath.startsWith("/chat/");
-          const currentConversationId = isInChat
-            ? currentPath.split("/")[2]
-            : null;
-
-          const isForOpenConversation =
-            currentConversationId &&
-            data.conversation_id === currentConversationId;
-
-          // Only show notifications if the conversation isn't currently open
-          if (!isForOpenConversation) {
-            this.notificationCounts.messages++;
-            this.updateChatNotificationBadge();
-            this.showToastNotification(
-              `New message from ${data.sender_username}: ${data.message_preview}`
-            );
-          }
+          this.handleNewMessageNotification(data);
         }
         break;
 
@@ -314,6 +312,31 @@ class NavigationManager {
         // Handle user online/offline status updates
         console.log(`User ${data.username} is now ${data.status}`);
         break;
+
+      case "user_status_batch":
+        (data.updates ?? []).forEach((update) =>
+          console.log(`User ${update.username} is now ${update.status}`)
+        );
+        break;
+    }
+  }
+
+  private handleNewMessageNotification(data: NotificationData): void {
+    // Check if this message is for the currently open conversation
+    const currentPath = window.location.pathname;
+    const isInChat = currentPath.startsWith("/chat/");
+    const currentConversationId = isInChat ? currentPath.split("/")[2] : null;
+
+    const isForOpenConversation =
+      currentConversationId && data.conversation_id === currentConversationId;
+
+    // Only show notifications if the conversation isn't currently open
+    if (!isForOpenConversation) {
+      this.notificationCounts.messages++;
+      this.updateChatNotificationBadge();
+      this.showToastNotification(
+        `New message from ${data.sender_username}: ${data.message_preview}`
+      );
     }
   }
 
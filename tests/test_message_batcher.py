@@ -0,0 +1,86 @@
+import asyncio
+import sqlite3
+from contextlib import asynccontextmanager
+
+import pytest
+
+from db import Database, MessageBatcher
+
+
+async def open_database(path):
+    db = Database(str(path))
+    await db.connect()
+    await db.create_tables()
+    return db
+
+
+async def fetch(db, query, params=()):
+    async with db.reader() as conn:
+        async with conn.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+
+def test_failed_message_leaves_no_rows_and_does_not_fail_the_batch(tmp_path):
+    async def run():
+        db = await open_database(tmp_path / "chat.db")
+        # Fails the conversation summary upsert, after the message row and unread counter were written
+        await db.conn.execute("""
+            CREATE TRIGGER reject_boom BEFORE INSERT ON conversations
+            WHEN NEW.last_message_text = 'boom'
+            BEGIN SELECT RAISE(ABORT, 'rejected'); END
+        """)
+        await db.conn.commit()
+        batcher = MessageBatcher(db, max_batch=8, max_delay_ms=50)
+        batcher.start()
+        try:
+            results = await asyncio.gather(
+                batcher.submit(1, 2, "hello"),
+                batcher.submit(1, 2, "boom", "client-1"),
+                batcher.submit(1, 2, "world"),
+                return_exceptions=True,
+            )
+            assert isinstance(results[1], sqlite3.IntegrityError)
+            assert [created for _, _, created in (results[0], results[2])] == [True, True]
+            assert batcher.stats()["batches"] == 1
+
+            assert await fetch(db, "SELECT message_text FROM messages ORDER BY id") == [("hello",), ("world",)]
+            assert await fetch(db, "SELECT count FROM unread_counts WHERE user_id = 2 AND other_user_id = 1") == [(2,)]
+
+            # The failed client id was not kept, so a retry is stored rather than reported as a duplicate
+            await db.conn.execute("DROP TRIGGER reject_boom")
+            await db.conn.commit()
+            _, _, created = await batcher.submit(1, 2, "boom", "client-1")
+            assert created
+        finally:
+            await batcher.close()
+            await db.close()
+
+    asyncio.run(run())
+
+
+class LockedDatabase:
+    """Stands in for a Database whose writer cannot be used"""
+
+    @asynccontextmanager
+    async def writer(self):
+        raise sqlite3.OperationalError("database is locked")
+        yield
+
+
+def test_batch_failure_fails_every_message_and_keeps_the_batcher_running():
+    async def run():
+        batcher = MessageBatcher(LockedDatabase(), max_batch=8, max_delay_ms=1)
+        batcher.start()
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(batcher.submit(1, 2, "a"), batcher.submit(1, 2, "b"), return_exceptions=True),
+                timeout=1,
+            )
+            assert all(isinstance(result, sqlite3.OperationalError) for result in results)
+            # Later messages still get an answer instead of waiting forever
+            with pytest.raises(sqlite3.OperationalError):
+                await asyncio.wait_for(batcher.submit(1, 2, "c"), timeout=1)
+        finally:
+            await batcher.close()
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from db import MIGRATIONS, Database
+
+
+async def open_database(path):
+    db = Database(str(path))
+    await db.connect()
+    return db
+
+
+async def schema_version(db):
+    async with db.reader() as conn:
+        async with conn.execute("PRAGMA user_version") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+def test_migrate_is_idempotent(tmp_path):
+    async def run():
+        db = await open_database(tmp_path / "chat.db")
+        try:
+            await db.create_tables()
+            assert await schema_version(db) == len(MIGRATIONS)
+            # Running again applies nothing and keeps the version
+            assert await db.migrate() == len(MIGRATIONS)
+            await db.create_tables()
+            assert await schema_version(db) == len(MIGRATIONS)
+        finally:
+            await db.close()
+
+    asyncio.run(run())
+
+
+def test_concurrent_startups_apply_each_migration_once(tmp_path, capsys):
+    async def run():
+        databases = [await open_database(tmp_path / "chat.db") for _ in range(4)]
+        try:
+            await asyncio.gather(*(db.create_tables() for db in databases))
+            for db in databases:
+                assert await schema_version(db) == len(MIGRATIONS)
+        finally:
+            for db in databases:
+                await db.close()
+
+    asyncio.run(run())
+    applied = [line for line in capsys.readouterr().out.splitlines() if line.startswith("Applied migration")]
+    assert sorted(applied) == sorted(f"Applied migration {number}" for number in range(1, len(MIGRATIONS) + 1))
+
+
+def test_failed_migration_stops_startup(tmp_path):
+    async def run():
+        db = await open_database(tmp_path / "chat.db")
+        try:
+            # A database from before usernames were unique, holding a duplicate
+            await db.conn.execute(
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT NOT NULL, "
+                "email TEXT NOT NULL, password TEXT NOT NULL)"
+            )
+            await db.conn.executemany(
+                "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                [("alice", "a1@example.com", "x"), ("alice", "a2@example.com", "x")],
+            )
+            await db.conn.commit()
+            with pytest.raises(RuntimeError, match="migration 2"):
+                await db.create_tables()
+            assert await schema_version(db) == 1
+        finally:
+            await db.close()
+
+    asyncio.run(run())
@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+from utils.connections import ConnectionRegistry
+from utils.presence import PresenceEngine
+from utils.pubsub import InProcessPubSub
+
+ALICE, BOB, EVE = 1, 2, 5
+FRIENDS = {ALICE: {BOB, EVE}, BOB: {ALICE}, EVE: {ALICE}}
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    async def close(self, code=1000):
+        pass
+
+
+async def friend_ids(user_id):
+    return FRIENDS.get(user_id, set())
+
+
+def make_engine(grace_period=0.2):
+    connections = ConnectionRegistry()
+    bus = InProcessPubSub()
+    presence = PresenceEngine(connections, bus, friend_ids, grace_period=grace_period, tick_ms=10)
+    return connections, bus, presence
+
+
+def open_socket(connections, presence, user_id, username):
+    websocket = RecordingWebSocket()
+    connection = connections.add(websocket, user_id, username)
+    presence.connected(user_id, username)
+    return websocket, connection
+
+
+def close_socket(connections, presence, connection):
+    connections.remove(connection)
+    presence.disconnected(connection.user_id, connection.username)
+
+
+def statuses(websocket):
+    """(username, status) pairs from the presence frames a socket received"""
+    updates = []
+    for frame in websocket.frames:
+        if frame["type"] == "user_status_update":
+            updates.append((frame["username"], frame["status"]))
+        elif frame["type"] == "user_status_batch":
+            updates.extend((update["username"], update["status"]) for update in frame["updates"])
+    return updates
+
+
+def test_reconnect_within_grace_period_is_not_reported():
+    async def run():
+        connections, _, presence = make_engine()
+        alice, _ = open_socket(connections, presence, ALICE, "alice")
+        _, bob_connection = open_socket(connections, presence, BOB, "bob")
+        await asyncio.sleep(0.05)
+        assert statuses(alice) == [("bob", "online")]
+
+        # A tab reload: the only socket closes and a new one opens before the grace period ends
+        close_socket(connections, presence, bob_connection)
+        open_socket(connections, presence, BOB, "bob")
+        await asyncio.sleep(0.3)
+        assert statuses(alice) == [("bob", "online")]
+        assert presence.stats()["suppressed_reconnects"] == 1
+        await presence.close()
+
+    asyncio.run(run())
+
+
+def test_offline_is_reported_once_the_grace_period_ends():
+    async def run():
+        connections, _, presence = make_engine()
+        alice, _ = open_socket(connections, presence, ALICE, "alice")
+        _, bob_connection = open_socket(connections, presence, BOB, "bob")
+        close_socket(connections, presence, bob_connection)
+        await asyncio.sleep(0.05)
+        assert presence.is_online(BOB)
+
+        await asyncio.sleep(0.3)
+        assert not presence.is_online(BOB)
+        assert presence.user_id_for("bob") is None
+        assert statuses(alice)[-1] == ("bob", "offline")
+        await presence.close()
+
+    asyncio.run(run())
+
+
+def test_changes_in_one_tick_reach_a_friend_as_one_frame():
+    async def run():
+        connections, _, presence = make_engine()
+        alice, _ = open_socket(connections, presence, ALICE, "alice")
+        await asyncio.sleep(0.05)
+        open_socket(connections, presence, BOB, "bob")
+        open_socket(connections, presence, EVE, "eve")
+        await asyncio.sleep(0.05)
+        assert alice.frames[-1]["type"] == "user_status_batch"
+        assert sorted(statuses(alice)) == [("bob", "online"), ("eve", "online")]
+        await presence.close()
+
+    asyncio.run(run())
+
+
+def test_worker_gone_takes_its_users_offline():
+    async def run():
+        connections, bus, presence = make_engine()
+        alice, _ = open_socket(connections, presence, ALICE, "alice")
+        # Eve is connected to another worker
+        bus._dispatch({"kind": "presence", "worker": "other", "user_id": EVE, "username": "eve", "online": True})
+        await asyncio.sleep(0.05)
+        assert presence.user_id_for("eve") == EVE
+
+        bus._dispatch({"kind": "worker_gone", "gone_worker": "other"})
+        await asyncio.sleep(0.05)
+        assert not presence.is_online(EVE)
+        assert presence.user_id_for("eve") is None
+        assert statuses(alice) == [("eve", "online"), ("eve", "offline")]
+        # Users of this worker are untouched
+        assert presence.is_online(ALICE)
+        await presence.close()
+
+    asyncio.run(run())
@@ -0,0 +1,63 @@
+import asyncio
+
+from utils.read_receipts import ReadReceiptBatcher
+
+
+def make_batcher(tick_ms=10):
+    stored = []
+    notified = []
+
+    async def advance(cursors):
+        stored.append(list(cursors))
+        return cursors
+
+    def notify(reader_id, reader_username, sender_id, message_id):
+        notified.append((reader_id, reader_username, sender_id, message_id))
+
+    return ReadReceiptBatcher(advance, notify, tick_ms=tick_ms), stored, notified
+
+
+def test_receipts_in_one_tick_are_coalesced_per_conversation():
+    async def run():
+        batcher, stored, notified = make_batcher()
+        await asyncio.gather(
+            batcher.submit(1, "alice", 2, 10),
+            batcher.submit(1, "alice", 2, 12),
+            batcher.submit(1, "alice", 2, 11),
+            batcher.submit(1, "alice", 3, 5),
+        )
+        assert stored == [[(1, 2, 12), (1, 3, 5)]]
+        assert notified == [(1, "alice", 2, 12), (1, "alice", 3, 5)]
+
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_the_rest_of_the_tick():
+    async def run():
+        batcher, stored, _ = make_batcher()
+
+        # Like the mark-read endpoint, each caller awaits its receipt in its own request task
+        async def mark_read(reader_id, reader_username, sender_id, message_id):
+            await batcher.submit(reader_id, reader_username, sender_id, message_id)
+
+        first = asyncio.create_task(mark_read(1, "alice", 2, 10))
+        second = asyncio.create_task(mark_read(3, "carol", 2, 11))
+        await asyncio.sleep(0)
+        first.cancel()
+        await second
+        assert first.cancelled()
+        # The cancelled caller's receipt is still written with the tick
+        assert stored == [[(1, 2, 10), (3, 2, 11)]]
+
+    asyncio.run(run())
+
+
+def test_close_flushes_pending_receipts():
+    async def run():
+        batcher, stored, _ = make_batcher(tick_ms=10_000)
+        waiter = batcher.submit(1, "alice", 2, 10)
+        await batcher.close()
+        assert waiter.done()
+        assert stored == [[(1, 2, 10)]]
+
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+import asyncio
+
+from utils.typing_indicators import TypingThrottle
+
+SENDER, RECIPIENT = 1, 2
+
+
+def make_throttle(interval_ms=100, expiry=1.0):
+    forwarded = []
+    throttle = TypingThrottle(
+        lambda sender_id, username, recipient_id, is_typing: forwarded.append(is_typing),
+        interval_ms=interval_ms,
+        expiry=expiry,
+    )
+    return throttle, forwarded
+
+
+def test_repeated_typing_events_are_forwarded_once():
+    async def run():
+        throttle, forwarded = make_throttle()
+        for _ in range(10):
+            throttle.update(SENDER, "alice", RECIPIENT, True)
+        assert forwarded == [True]
+        assert throttle.stats()["received"] == 10
+
+    asyncio.run(run())
+
+
+def test_stop_within_the_interval_is_deferred_to_the_end_of_it():
+    async def run():
+        throttle, forwarded = make_throttle()
+        throttle.update(SENDER, "alice", RECIPIENT, True)
+        throttle.update(SENDER, "alice", RECIPIENT, False)
+        assert forwarded == [True]
+        await asyncio.sleep(0.15)
+        assert forwarded == [True, False]
+
+    asyncio.run(run())
+
+
+def test_changes_that_cancel_out_within_the_interval_are_not_forwarded():
+    async def run():
+        throttle, forwarded = make_throttle()
+        throttle.update(SENDER, "alice", RECIPIENT, True)
+        throttle.update(SENDER, "alice", RECIPIENT, False)
+        throttle.update(SENDER, "alice", RECIPIENT, True)
+        await asyncio.sleep(0.15)
+        assert forwarded == [True]
+
+    asyncio.run(run())
+
+
+def test_typing_expires_when_events_stop():
+    async def run():
+        throttle, forwarded = make_throttle(expiry=0.1)
+        throttle.update(SENDER, "alice", RECIPIENT, True)
+        await asyncio.sleep(0.2)
+        assert forwarded == [True, False]
+        assert throttle.stats()["expired"] == 1
+        # The pair is forgotten once the interval after the stop has passed
+        await asyncio.sleep(0.15)
+        assert throttle.stats()["active"] == 0
+
+    asyncio.run(run())
+
+
+def test_clear_sender_reports_stop_and_forgets_state():
+    async def run():
+        throttle, forwarded = make_throttle()
+        throttle.update(SENDER, "alice", RECIPIENT, True)
+        throttle.clear_sender(SENDER)
+        assert forwarded == [True, False]
+        assert throttle.stats()["active"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,149 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a time-to-live"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store a value, optionally with its own time-to-live in seconds"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class UserCache:
+    """Users cached by both username and id"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0):
+        # Every user takes one entry per key
+        self._cache = TTLCache(max_size * 2, ttl)
+
+    def get_by_username(self, username: str):
+        return self._cache.get(("username", username))
+
+    def get_by_id(self, user_id: int):
+        return self._cache.get(("id", user_id))
+
+    def add(self, user):
+        self._cache.set(("username", user.username), user)
+        self._cache.set(("id", user.id), user)
+
+    def invalidate(self, username: Optional[str] = None, user_id: Optional[int] = None):
+        """Drop a user under both keys, given either of them"""
+        for user in (
+            self._cache.pop(("username", username)) if username is not None else None,
+            self._cache.pop(("id", user_id)) if user_id is not None else None,
+        ):
+            if user is not None:
+                self._cache.pop(("username", user.username))
+                self._cache.pop(("id", user.id))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+class FriendGraph:
+    """Accepted-friend adjacency sets, loaded lazily per user and patched in place on changes"""
+
+    def __init__(self, max_size: int = 4096, ttl: float = 300.0):
+        self._cache = TTLCache(max_size, ttl)
+        # Bumped on every change to a user's friendships, so a load that raced a change is not cached
+        self._generations: Dict[int, int] = {}
+        self._epoch = 0
+
+    def get(self, user_id: int) -> Optional[frozenset]:
+        return self._cache.get(user_id)
+
+    def generation(self, user_id: int) -> Tuple[int, int]:
+        """Token to take before loading a user's friends from the database and pass to set()"""
+        return self._epoch, self._generations.get(user_id, 0)
+
+    def set(self, user_id: int, friend_ids: Iterable[int], generation: Optional[Tuple[int, int]] = None):
+        """Cache a user's friend ids, unless they changed since the given generation was taken"""
+        if generation is not None and generation != self.generation(user_id):
+            return
+        self._cache.set(user_id, frozenset(friend_ids))
+
+    def _bump(self, user_id: int):
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def add_edge(self, a: int, b: int):
+        """Record a new friendship for whichever side is already loaded"""
+        for user_id, friend_id in ((a, b), (b, a)):
+            self._bump(user_id)
+            friend_ids = self._cache.get(user_id)
+            if friend_ids is not None:
+                self._cache.set(user_id, friend_ids | {friend_id})
+
+    def remove_edge(self, a: int, b: int):
+        for user_id, friend_id in ((a, b), (b, a)):
+            self._bump(user_id)
+            friend_ids = self._cache.get(user_id)
+            if friend_ids is not None:
+                self._cache.set(user_id, friend_ids - {friend_id})
+
+    def invalidate(self, *user_ids: int):
+        for user_id in user_ids:
+            self._bump(user_id)
+            self._cache.pop(user_id)
+
+    def clear(self):
+        self._epoch += 1
+        self._generations.clear()
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
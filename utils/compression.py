@@ -0,0 +1,105 @@
+import logging
+import os
+from typing import List, Sequence, Tuple
+
+from dotenv import load_dotenv
+from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+from websockets.extensions.base import Extension, ServerExtensionFactory
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import Frame, Opcode
+from websockets.server import ServerProtocol
+from websockets.typing import ExtensionParameter
+
+load_dotenv()
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() not in ("0", "off", "false", "no")
+
+
+# Data frames that carry a message; control frames are never compressed
+DATA_OPCODES = (Opcode.TEXT, Opcode.BINARY)
+
+# permessage-deflate settings for /ws, applied when uvicorn runs with CompressedWebSocketProtocol
+WS_COMPRESSION = _env_flag("WS_COMPRESSION", "on")
+# Messages smaller than this many bytes are sent uncompressed
+WS_COMPRESSION_MIN_SIZE = int(os.getenv("WS_COMPRESSION_MIN_SIZE", 64))
+# zlib level, 1 (fastest) to 9 (smallest)
+WS_COMPRESSION_LEVEL = int(os.getenv("WS_COMPRESSION_LEVEL", 6))
+# Keep the compression window between messages; better ratios but memory per connection
+WS_COMPRESSION_CONTEXT_TAKEOVER = _env_flag("WS_COMPRESSION_CONTEXT_TAKEOVER", "on")
+# LZ77 window size (9-15); each connection keeps roughly 2 ** (bits + 2) bytes per direction
+WS_COMPRESSION_WINDOW_BITS = int(os.getenv("WS_COMPRESSION_WINDOW_BITS", 12))
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves messages below min_size uncompressed"""
+
+    def __init__(self, *args, min_size: int = WS_COMPRESSION_MIN_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.compressed = 0
+        self.skipped = 0
+
+    def encode(self, frame: Frame) -> Frame:
+        # RFC 7692 lets any message go out without RSV1; only whole, unfragmented messages are skipped
+        if frame.fin and frame.opcode in DATA_OPCODES and len(frame.data) < self.min_size:
+            self.skipped += 1
+            return frame
+        if frame.opcode in DATA_OPCODES:
+            self.compressed += 1
+        return super().encode(frame)
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate like websockets does, then applies the size threshold"""
+
+    def __init__(self, *args, min_size: int = WS_COMPRESSION_MIN_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def process_request_params(
+        self,
+        params: Sequence[ExtensionParameter],
+        accepted_extensions: Sequence[Extension],
+    ) -> Tuple[List[ExtensionParameter], PerMessageDeflate]:
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+        )
+
+
+def deflate_factory(
+    min_size: int = WS_COMPRESSION_MIN_SIZE,
+    level: int = WS_COMPRESSION_LEVEL,
+    context_takeover: bool = WS_COMPRESSION_CONTEXT_TAKEOVER,
+    window_bits: int = WS_COMPRESSION_WINDOW_BITS,
+) -> ThresholdPerMessageDeflateFactory:
+    return ThresholdPerMessageDeflateFactory(
+        server_no_context_takeover=not context_takeover,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={"level": level, "memLevel": 5},
+        min_size=min_size,
+    )
+
+
+def server_extensions() -> List[ServerExtensionFactory]:
+    return [deflate_factory()] if WS_COMPRESSION else []
+
+
+class CompressedWebSocketProtocol(WebSocketsSansIOProtocol):
+    """uvicorn's websockets protocol with permessage-deflate configured from the environment"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.conn = ServerProtocol(
+            extensions=server_extensions(),
+            max_size=self.config.ws_max_size,
+            logger=logging.getLogger("uvicorn.error"),
+        )
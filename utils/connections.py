@@ -0,0 +1,230 @@
+import asyncio
+import os
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+from fastapi import WebSocket, status
+
+from utils.serialization import Frame
+
+load_dotenv()
+
+# Frames buffered per connection before the overflow policy kicks in
+OUTBOUND_QUEUE_SIZE = int(os.getenv("WS_OUTBOUND_QUEUE_SIZE", 256))
+# What to do with a full queue once no droppable frames are left: "disconnect" or "drop"
+OUTBOUND_OVERFLOW_POLICY = os.getenv("WS_OUTBOUND_OVERFLOW_POLICY", "disconnect")
+
+# (lower bound, label) of the queue-depth buckets connections are counted in for metrics
+DEPTH_BUCKETS = ((256, "256+"), (64, "64-255"), (16, "16-63"), (1, "1-15"), (0, "0"))
+
+
+def _depth_bucket(depth: int) -> str:
+    for low, label in DEPTH_BUCKETS:
+        if depth >= low:
+            return label
+    return "0"
+
+
+class Connection:
+    """An open WebSocket, the user it belongs to, its wire format and its outbound frame queue"""
+
+    __slots__ = (
+        "websocket", "user_id", "username", "binary", "protocol_version", "max_queue", "overflow_policy",
+        "closed", "sent", "dropped", "max_depth",
+        "_outbox", "_ready", "_writer", "_on_close",
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        username: str,
+        binary: bool = False,
+        protocol_version: int = 1,
+        max_queue: int = OUTBOUND_QUEUE_SIZE,
+        overflow_policy: str = OUTBOUND_OVERFLOW_POLICY,
+        on_close: Optional[Callable[["Connection"], None]] = None,
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.username = username
+        # True when the client negotiated the MessagePack subprotocol
+        self.binary = binary
+        # Frame layout the client understands, see PROTOCOL_VERSION in main.py
+        self.protocol_version = protocol_version
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+        # (frame, droppable) pairs waiting for the writer task
+        self._outbox: deque = deque()
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._on_close = on_close
+
+    def start(self):
+        """Start the task that drains the outbound queue onto the socket"""
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._run())
+
+    def send(self, frame: Frame, droppable: bool = False) -> bool:
+        """Queue a frame without waiting for the client. Returns whether it was queued"""
+        if self.closed:
+            return False
+        if len(self._outbox) >= self.max_queue:
+            if droppable:
+                self.dropped += 1
+                return False
+            if not self._drop_oldest_droppable():
+                if self.overflow_policy == "drop":
+                    self.dropped += 1
+                    return False
+                print(f"Outbound queue full for user {self.username}, disconnecting")
+                self.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                return False
+        self._outbox.append((frame, droppable))
+        if len(self._outbox) > self.max_depth:
+            self.max_depth = len(self._outbox)
+        self._ready.set()
+        return True
+
+    def _drop_oldest_droppable(self) -> bool:
+        for index, (_, droppable) in enumerate(self._outbox):
+            if droppable:
+                del self._outbox[index]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _run(self):
+        try:
+            while True:
+                while not self._outbox:
+                    self._ready.clear()
+                    await self._ready.wait()
+                frame, _ = self._outbox[0]
+                # A frame that cannot be encoded is skipped rather than taking the writer down
+                try:
+                    data = frame.binary if self.binary else frame.text
+                except Exception as e:
+                    print(f"WebSocket encode error for user {self.username}: {e}")
+                    self._outbox.popleft()
+                    self.dropped += 1
+                    continue
+                if self.binary:
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+                self._outbox.popleft()
+                self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"WebSocket send error for user {self.username}: {e}")
+            self._writer = None
+            # Close the socket too, so the client reconnects and resumes instead of hanging unregistered
+            self.close(code=status.WS_1011_INTERNAL_ERROR)
+
+    def close(self, code: Optional[int] = None):
+        """Stop the writer and forget queued frames; with a code, also close the socket"""
+        if self.closed:
+            return
+        self.closed = True
+        self._outbox.clear()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+        if self._on_close is not None:
+            self._on_close(self)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    @property
+    def depth(self) -> int:
+        return len(self._outbox)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._outbox),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+
+class ConnectionRegistry:
+    """Open WebSocket connections indexed by user id (one user may have several tabs open)"""
+
+    def __init__(self):
+        # Insertion-ordered dicts used as sets give O(1) add/remove per user
+        self._by_user: Dict[int, Dict[Connection, None]] = {}
+        self._count = 0
+
+    def add(
+        self, websocket: WebSocket, user_id: int, username: str, binary: bool = False, protocol_version: int = 1
+    ) -> Connection:
+        connection = Connection(websocket, user_id, username, binary, protocol_version, on_close=self.remove)
+        self._by_user.setdefault(user_id, {})[connection] = None
+        self._count += 1
+        connection.start()
+        return connection
+
+    def remove(self, connection: Connection) -> bool:
+        """Forget a connection; safe to call more than once. Returns whether it was registered"""
+        user_connections = self._by_user.get(connection.user_id)
+        if user_connections is None or connection not in user_connections:
+            return False
+        del user_connections[connection]
+        if not user_connections:
+            del self._by_user[connection.user_id]
+        self._count -= 1
+        connection.close()
+        return True
+
+    def connections_for(self, user_id: int) -> List[Connection]:
+        """Snapshot of a user's connections, safe to iterate while sending"""
+        return list(self._by_user.get(user_id, ()))
+
+    def connections_for_users(self, user_ids: Iterable[int]) -> List[Connection]:
+        return [
+            connection
+            for user_id in set(user_ids)
+            for connection in self._by_user.get(user_id, ())
+        ]
+
+    def all_connections(self) -> List[Connection]:
+        return [connection for connections in self._by_user.values() for connection in connections]
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._by_user
+
+    def online_users(self, user_ids: Iterable[int]) -> set:
+        """The subset of user_ids with at least one open connection"""
+        return {user_id for user_id in user_ids if user_id in self._by_user}
+
+    def stats(self) -> dict:
+        """Connection counts and outbound queue totals; nothing that identifies a user"""
+        per_connection = [connection.stats() for connection in self.all_connections()]
+        depth_histogram = {label: 0 for _, label in reversed(DEPTH_BUCKETS)}
+        for item in per_connection:
+            depth_histogram[_depth_bucket(item["depth"])] += 1
+        return {
+            "connections": self._count,
+            "users": len(self._by_user),
+            "queued": sum(item["depth"] for item in per_connection),
+            "max_depth": max((item["max_depth"] for item in per_connection), default=0),
+            "dropped": sum(item["dropped"] for item in per_connection),
+            "depth_histogram": depth_histogram,
+        }
+
+    def __len__(self) -> int:
+        return self._count
@@ -0,0 +1,214 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from utils.connections import ConnectionRegistry
+from utils.pubsub import PubSub
+from utils.serialization import Frame
+
+load_dotenv()
+
+# How long a user with no open sockets still counts as online (covers tab reloads)
+PRESENCE_GRACE_SECONDS = float(os.getenv("PRESENCE_GRACE_SECONDS", 5))
+# Presence changes made within one tick are sent to each friend as a single frame
+PRESENCE_TICK_MS = float(os.getenv("PRESENCE_TICK_MS", 100))
+
+
+class PresenceEngine:
+    """Turns socket opens and closes into debounced, batched online/offline updates for friends
+
+    Each worker announces its own users on the message bus; a user counts as online
+    while any worker reports them, so every worker shares the same view.
+    """
+
+    def __init__(
+        self,
+        connections: ConnectionRegistry,
+        bus: PubSub,
+        friend_ids: Callable[[int], Awaitable[Iterable[int]]],
+        grace_period: float = PRESENCE_GRACE_SECONDS,
+        tick_ms: float = PRESENCE_TICK_MS,
+    ):
+        self.connections = connections
+        self.bus = bus
+        self.friend_ids = friend_ids
+        self.grace_period = grace_period
+        self.tick = tick_ms / 1000
+        # user_id -> timer that marks the user offline once the grace period is over
+        self._offline_timers: Dict[int, asyncio.TimerHandle] = {}
+        # Users this worker reports online: user_id -> username
+        self._local: Dict[int, str] = {}
+        # Users online on any worker: user_id -> ids of the workers reporting them
+        self._workers: Dict[int, Set[str]] = {}
+        self._usernames: Dict[int, str] = {}
+        self._user_ids: Dict[str, int] = {}
+        # user_id -> latest unsent status update
+        self._pending: Dict[int, dict] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.transitions = 0
+        self.suppressed = 0
+        self.frames = 0
+        bus.subscribe(self.handle_event)
+
+    def connected(self, user_id: int, username: str):
+        """Call after a connection was added to the registry"""
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            # Reconnected within the grace period: friends never saw the user leave
+            timer.cancel()
+            self.suppressed += 1
+            return
+        if user_id not in self._local:
+            self._local[user_id] = username
+            self.bus.publish({"kind": "presence", "user_id": user_id, "username": username, "online": True})
+
+    def disconnected(self, user_id: int, username: str):
+        """Call after a connection was removed from the registry"""
+        if self.connections.is_online(user_id) or user_id in self._offline_timers:
+            return
+        if self.grace_period <= 0:
+            self._offline_after_grace(user_id, username)
+            return
+        loop = asyncio.get_running_loop()
+        self._offline_timers[user_id] = loop.call_later(
+            self.grace_period, self._offline_after_grace, user_id, username
+        )
+
+    def _offline_after_grace(self, user_id: int, username: str):
+        self._offline_timers.pop(user_id, None)
+        if not self.connections.is_online(user_id) and self._local.pop(user_id, None) is not None:
+            self.bus.publish({"kind": "presence", "user_id": user_id, "username": username, "online": False})
+
+    def is_online(self, user_id: int) -> bool:
+        """Whether the user has a socket open on any worker"""
+        return user_id in self._workers
+
+    def user_id_for(self, username: str) -> Optional[int]:
+        """Id of a user who is online on any worker"""
+        return self._user_ids.get(username)
+
+    def online_users(self, user_ids: Iterable[int]) -> list:
+        return [user_id for user_id in user_ids if user_id in self._workers]
+
+    def handle_event(self, event: dict):
+        """Message bus handler keeping the cross-worker view of who is online"""
+        kind = event.get("kind")
+        if kind == "presence":
+            self._apply(event["worker"], event["user_id"], event["username"], event["online"])
+        elif kind == "presence_snapshot":
+            if event["worker"] != self.bus.worker_id:
+                self._replace_worker(event["worker"], dict(event["users"]))
+                if event.get("reply"):
+                    self._publish_snapshot(reply=False)
+        elif kind == "worker_gone":
+            self._replace_worker(event["gone_worker"], {})
+        elif kind == "bus_disconnected":
+            # Other workers' reports may be stale; they resend them once the bus is back
+            others = {worker for workers in self._workers.values() for worker in workers}
+            others.discard(self.bus.worker_id)
+            for worker in others:
+                self._replace_worker(worker, {})
+        elif kind == "bus_connected":
+            self._publish_snapshot(reply=True)
+
+    def _publish_snapshot(self, reply: bool):
+        self.bus.publish({
+            "kind": "presence_snapshot",
+            "users": [[user_id, username] for user_id, username in self._local.items()],
+            "reply": reply,
+        })
+
+    def _replace_worker(self, worker: str, users: Dict[int, str]):
+        stale = [user_id for user_id, workers in self._workers.items() if worker in workers and user_id not in users]
+        for user_id in stale:
+            self._apply(worker, user_id, self._usernames[user_id], False)
+        for user_id, username in users.items():
+            self._apply(worker, user_id, username, True)
+
+    def _apply(self, worker: str, user_id: int, username: str, online: bool):
+        workers = self._workers.get(user_id)
+        if online:
+            if workers is None:
+                self._workers[user_id] = {worker}
+                self._usernames[user_id] = username
+                self._user_ids[username] = user_id
+                self._transition(user_id, username, "online")
+            else:
+                workers.add(worker)
+        elif workers is not None and worker in workers:
+            workers.discard(worker)
+            if not workers:
+                del self._workers[user_id]
+                del self._usernames[user_id]
+                self._user_ids.pop(username, None)
+                self._transition(user_id, username, "offline")
+
+    def _transition(self, user_id: int, username: str, status: str):
+        self.transitions += 1
+        self._pending[user_id] = {
+            "user_id": user_id,
+            "username": username,
+            "status": status,
+            "timestamp": datetime.now().isoformat(),
+        }
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_tick())
+
+    async def _flush_after_tick(self):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Send every pending update, one frame per friend connected to this worker"""
+        pending, self._pending = self._pending, {}
+        by_recipient: Dict[int, list] = {}
+        for user_id, update in pending.items():
+            try:
+                friend_ids = await self.friend_ids(user_id)
+            except Exception as e:
+                print(f"Error loading friends for presence update of user {user_id}: {e}")
+                continue
+            for friend_id in self.connections.online_users(friend_ids):
+                by_recipient.setdefault(friend_id, []).append(update)
+
+        # Recipients with the same set of updates share one frame, encoded once
+        frames: Dict[Tuple[int, ...], Frame] = {}
+        for recipient_id, updates in by_recipient.items():
+            key = tuple(update["user_id"] for update in updates)
+            frame = frames.get(key)
+            if frame is None:
+                if len(updates) == 1:
+                    frame = Frame({"type": "user_status_update", **updates[0]})
+                else:
+                    frame = Frame({"type": "user_status_batch", "updates": updates})
+                frames[key] = frame
+            for connection in self.connections.connections_for(recipient_id):
+                connection.send(frame)
+                self.frames += 1
+
+    async def close(self):
+        """Cancel pending offline timers and send whatever is still queued"""
+        for timer in self._offline_timers.values():
+            timer.cancel()
+        self._offline_timers.clear()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "online_users": len(self._workers),
+            "local_online_users": len(self._local),
+            "pending_offline": len(self._offline_timers),
+            "pending_updates": len(self._pending),
+            "transitions": self.transitions,
+            "suppressed_reconnects": self.suppressed,
+            "frames": self.frames,
+        }
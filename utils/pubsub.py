@@ -0,0 +1,265 @@
+import asyncio
+import fcntl
+import os
+import struct
+import uuid
+from typing import Callable, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from utils.serialization import decode, encode
+
+load_dotenv()
+
+# "local" keeps events inside this process; "unix" shares them with every worker on the machine
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "local")
+# Unix domain socket the workers meet on; the worker holding PUBSUB_SOCKET + ".lock" relays for the others
+PUBSUB_SOCKET = os.getenv("PUBSUB_SOCKET", "/tmp/chat-py-bus.sock")
+# A peer whose unsent backlog grows past this many bytes is dropped and has to reconnect
+PUBSUB_MAX_BACKLOG = int(os.getenv("PUBSUB_MAX_BACKLOG", 16 * 1024 * 1024))
+
+_HEADER = struct.Struct("!I")
+MAX_EVENT_SIZE = 16 * 1024 * 1024
+
+
+class PubSub:
+    """Fans events out to every worker process, this one included"""
+
+    backend = "base"
+
+    def __init__(self):
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._handlers: List[Callable[[dict], None]] = []
+        self.published = 0
+        self.received = 0
+
+    def subscribe(self, handler: Callable[[dict], None]):
+        """Run handler(event) synchronously for every event
+
+        Besides published events, handlers see {"kind": "bus_connected"} and
+        {"kind": "bus_disconnected"} as the link to the other workers comes and goes,
+        and {"kind": "worker_gone", "gone_worker": id} when another worker leaves.
+        """
+        self._handlers.append(handler)
+
+    async def start(self):
+        self._dispatch({"kind": "bus_connected"})
+
+    async def close(self):
+        pass
+
+    def publish(self, event: dict):
+        """Handle an event in this process right away and send it to the other workers"""
+        event["worker"] = self.worker_id
+        self.published += 1
+        self._dispatch(event)
+        self._send(event)
+
+    def _send(self, event: dict):
+        pass
+
+    def _dispatch(self, event: dict):
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                print(f"Error handling {event.get('kind')} event: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "worker_id": self.worker_id,
+            "published": self.published,
+            "received": self.received,
+        }
+
+
+class InProcessPubSub(PubSub):
+    """Single-process bus: publishing is a direct call into the handlers"""
+
+    backend = "local"
+
+
+class UnixSocketPubSub(PubSub):
+    """Bus for several workers on one machine, relayed over a Unix domain socket"""
+
+    backend = "unix"
+
+    def __init__(self, path: str = PUBSUB_SOCKET, max_backlog: int = PUBSUB_MAX_BACKLOG):
+        super().__init__()
+        self.path = path
+        self.max_backlog = max_backlog
+        self.is_hub = False
+        self._lock_file = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: dict = {}  # StreamWriter -> worker id (hub only)
+        self._upstream: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._peer_tasks: Set[asyncio.Task] = set()
+        self._closing = False
+        self.reconnects = 0
+        self.dropped_peers = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._maintain())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            print(f"Message bus at {self.path} not reachable yet, retrying in the background")
+
+    async def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+        for task in list(self._peer_tasks):
+            task.cancel()
+        for writer in list(self._peers):
+            writer.close()
+        self._peers.clear()
+        if self._upstream is not None:
+            self._upstream.close()
+            self._upstream = None
+        if self._server is not None:
+            self._server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _maintain(self):
+        # Whoever holds the lock file is the hub and relays for everyone else. When the hub
+        # exits the kernel releases the lock, and a worker that lost its link takes over
+        delay = 0.05
+        while not self._closing:
+            if self._try_lock():
+                await self._serve()
+                return
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                # The hub is starting or just went away; try to take over after a short wait
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                continue
+            delay = 0.05
+            self._upstream = writer
+            self._connected.set()
+            # Introduce this worker so the hub can report it gone later
+            self.publish({"kind": "worker_joined"})
+            self._dispatch({"kind": "bus_connected"})
+            try:
+                await self._read_events(reader, None)
+            finally:
+                self._upstream = None
+                self._connected.clear()
+                writer.close()
+                if not self._closing:
+                    self.reconnects += 1
+                    print("Lost connection to the message bus hub, reconnecting")
+                    self._dispatch({"kind": "bus_disconnected"})
+
+    def _try_lock(self) -> bool:
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def _serve(self):
+        # Holding the lock means any socket file left behind belongs to a dead hub
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._accept_peer, path=self.path)
+        self.is_hub = True
+        print(f"Message bus hub listening on {self.path}")
+        self._connected.set()
+        self._dispatch({"kind": "bus_connected"})
+
+    async def _accept_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._peer_tasks.add(task)
+        self._peers[writer] = None
+        try:
+            await self._read_events(reader, writer)
+        except asyncio.CancelledError:
+            # close() cancels peer tasks; asyncio would log a cancelled connection callback as an error
+            pass
+        finally:
+            self._peer_tasks.discard(task)
+            worker_id = self._peers.pop(writer, None)
+            writer.close()
+            if worker_id is not None and not self._closing:
+                # Let every worker forget the presence state that worker reported
+                self.publish({"kind": "worker_gone", "gone_worker": worker_id})
+
+    async def _read_events(self, reader: asyncio.StreamReader, source: Optional[asyncio.StreamWriter]):
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                (size,) = _HEADER.unpack(header)
+                if size > MAX_EVENT_SIZE:
+                    print(f"Message bus event of {size} bytes exceeds the limit, dropping the link")
+                    return
+                body = await reader.readexactly(size)
+                event = decode(body)
+                self.received += 1
+                if source is not None:
+                    if self._peers.get(source) is None:
+                        self._peers[source] = event.get("worker")
+                    # Relay the already-encoded bytes to every other worker
+                    self._write_peers(header + body, exclude=source)
+                self._dispatch(event)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+
+    def _send(self, event: dict):
+        body = encode(event).encode()
+        data = _HEADER.pack(len(body)) + body
+        if self.is_hub:
+            self._write_peers(data)
+        elif self._upstream is not None:
+            self._write(self._upstream, data)
+
+    def _write_peers(self, data: bytes, exclude: Optional[asyncio.StreamWriter] = None):
+        for writer in list(self._peers):
+            if writer is not exclude:
+                self._write(writer, data)
+
+    def _write(self, writer: asyncio.StreamWriter, data: bytes):
+        if writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > self.max_backlog:
+            # A stalled worker must not grow this process's memory without bound
+            self.dropped_peers += 1
+            print("Message bus peer is not reading, dropping it")
+            writer.close()
+            return
+        writer.write(data)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "path": self.path,
+            "role": "hub" if self.is_hub else "worker",
+            "connected": self._connected.is_set(),
+            "peers": len(self._peers),
+            "reconnects": self.reconnects,
+            "dropped_peers": self.dropped_peers,
+        }
+
+
+def create_pubsub(backend: str = PUBSUB_BACKEND) -> PubSub:
+    if backend == "unix":
+        return UnixSocketPubSub()
+    if backend != "local":
+        print(f"Unknown PUBSUB_BACKEND {backend!r}, using the in-process bus")
+    return InProcessPubSub()
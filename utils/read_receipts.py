@@ -0,0 +1,93 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Read receipts reported within one tick are written in one transaction, one per conversation
+READ_RECEIPT_TICK_MS = float(os.getenv("READ_RECEIPT_TICK_MS", 100))
+
+
+class ReadReceiptBatcher:
+    """Coalesces read receipts into one read-cursor update and notification per conversation per tick"""
+
+    def __init__(
+        self,
+        advance: Callable[[List[Tuple[int, int, int]]], Awaitable[List[Tuple[int, int, int]]]],
+        notify: Callable[[int, str, int, int], None],
+        tick_ms: float = READ_RECEIPT_TICK_MS,
+    ):
+        # advance([(reader_id, sender_id, message_id), ...]) stores the cursors and returns the ones that moved
+        self.advance = advance
+        # notify(reader_id, reader_username, sender_id, message_id) tells the sender how far the reader got
+        self.notify = notify
+        self.tick = tick_ms / 1000
+        # (reader_id, sender_id) -> (highest message id read, reader username)
+        self._pending: Dict[Tuple[int, int], Tuple[int, str]] = {}
+        # One future per submit() caller, so a cancelled caller cannot cancel the others
+        self._waiters: List[asyncio.Future] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.flushes = 0
+        self.advanced = 0
+
+    def submit(self, reader_id: int, reader_username: str, sender_id: int, message_id: int) -> asyncio.Future:
+        """Record that the reader has read the sender's messages up to message_id
+
+        The returned future resolves once the receipt's tick has been written.
+        """
+        self.received += 1
+        key = (reader_id, sender_id)
+        pending = self._pending.get(key)
+        if pending is None or message_id > pending[0]:
+            self._pending[key] = (message_id, reader_username)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_after_tick())
+        return waiter
+
+    async def _flush_after_tick(self):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write every pending cursor and notify the senders whose messages were newly read"""
+        pending, self._pending = self._pending, {}
+        waiters, self._waiters = self._waiters, []
+        if pending:
+            try:
+                advanced = await self.advance([
+                    (reader_id, sender_id, message_id)
+                    for (reader_id, sender_id), (message_id, _) in pending.items()
+                ])
+            except Exception as e:
+                print(f"Error storing read receipts: {e}")
+                advanced = []
+            self.flushes += 1
+            self.advanced += len(advanced)
+            for reader_id, sender_id, message_id in advanced:
+                self.notify(reader_id, pending[(reader_id, sender_id)][1], sender_id, message_id)
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def close(self):
+        """Write whatever is still pending"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "received": self.received,
+            "flushes": self.flushes,
+            "advanced": self.advanced,
+        }
@@ -1,5 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
+import asyncio
+import hashlib
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status
@@ -9,6 +13,7 @@ from dotenv import load_dotenv
 from pydantic import SecretStr
 
 from models.auth import UserInDB
+from utils.cache import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -21,11 +26,90 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt runs on this many threads, so at most this many hashes are computed at once
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Password hashes allowed to wait for a thread; beyond that requests get a 503 instead of queueing without bound
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 64))
+
+# Usernames of already-verified tokens, keyed by token hash and kept until the token expires
+verified_tokens = TTLCache(
+    int(os.getenv("TOKEN_CACHE_SIZE", 4096)),
+    ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool so logins and signups never block the event loop"""
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        # bcrypt releases the GIL while hashing, so threads run it in parallel
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = asyncio.Semaphore(workers)
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+        self.run_time_total = 0.0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def _run(self, func, *args):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        # Time spent waiting for a free thread is the queue time reported in stats()
+        submitted = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        queued = started - submitted
+        self.queue_time_total += queued
+        self.queue_time_max = max(self.queue_time_max, queued)
+        self.active += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.active -= 1
+            self._slots.release()
+            self.completed += 1
+            self.run_time_total += time.perf_counter() - started
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_ms_avg": round(self.queue_time_total * 1000 / self.completed, 3) if self.completed else 0.0,
+            "queue_ms_max": round(self.queue_time_max * 1000, 3),
+            "run_ms_avg": round(self.run_time_total * 1000 / self.completed, 3) if self.completed else 0.0,
+        }
+
+
+# Shared by every request that hashes or checks a password
+password_hasher = PasswordHasher()
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     if expires_delta:
@@ -37,11 +121,18 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 def verify_token(token: str) -> Optional[str]:
+    """Return the username of a valid token, checking each distinct token's signature only once"""
+    key = hashlib.sha256(token.encode()).digest()
+    username = verified_tokens.get(key)
+    if username is not None:
+        return username
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             return None
-        return username
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+    exp = payload.get("exp")
+    verified_tokens.set(key, username, ttl=exp - time.time() if exp is not None else None)
+    return username
\ No newline at end of file
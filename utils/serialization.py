@@ -0,0 +1,83 @@
+import json
+import os
+from typing import Any, List, Optional
+
+from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+load_dotenv()
+
+# "auto" uses orjson when it is installed, "json" forces the standard library encoder
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+
+def _json_encode(payload: Any) -> str:
+    # Compact separators keep frames small; ensure_ascii=False avoids escaping non-ASCII text
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def _orjson_encode(payload: Any) -> str:
+    return orjson.dumps(payload).decode()
+
+
+# encode() turns a frame payload into text once, so a broadcast reuses it for every recipient
+if orjson is not None and JSON_BACKEND != "json":
+    BACKEND = "orjson"
+    encode = _orjson_encode
+    decode = orjson.loads
+else:
+    if JSON_BACKEND == "orjson":
+        print("JSON_BACKEND=orjson but orjson is not installed, using the json module")
+    BACKEND = "json"
+    encode = _json_encode
+    decode = json.loads
+
+# Sec-WebSocket-Protocol value a client offers to receive and send MessagePack binary frames
+MSGPACK_SUBPROTOCOL = "chat.msgpack"
+
+
+def encode_binary(payload: Any) -> bytes:
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def decode_binary(data: bytes) -> Any:
+    return msgpack.unpackb(data, raw=False)
+
+
+def select_subprotocol(offered: List[str]) -> Optional[str]:
+    """Pick the binary subprotocol if the client offered it and msgpack is installed"""
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in offered:
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+class Frame:
+    """An outbound event, encoded at most once per wire format however many sockets it goes to"""
+
+    __slots__ = ("payload", "_text", "_binary")
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self._text: Optional[str] = None
+        self._binary: Optional[bytes] = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = encode(self.payload)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = encode_binary(self.payload)
+        return self._binary
@@ -0,0 +1,144 @@
+import asyncio
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Minimum time between two typing state changes forwarded for the same sender and recipient
+TYPING_THROTTLE_MS = float(os.getenv("TYPING_THROTTLE_MS", 500))
+# A sender that stops sending typing events is reported as no longer typing after this long
+TYPING_EXPIRY_SECONDS = float(os.getenv("TYPING_EXPIRY_SECONDS", 5))
+
+
+class _TypingState:
+    """Typing state of one sender towards one recipient"""
+
+    __slots__ = ("username", "forwarded", "forwarded_at", "pending", "flush_timer", "expiry_timer")
+
+    def __init__(self, username: str):
+        self.username = username
+        self.forwarded = False
+        self.forwarded_at = float("-inf")
+        self.pending: Optional[bool] = None
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+        self.expiry_timer: Optional[asyncio.TimerHandle] = None
+
+
+class TypingThrottle:
+    """Coalesces keystroke-rate typing events into at most one forwarded change per interval"""
+
+    def __init__(
+        self,
+        forward: Callable[[int, str, int, bool], None],
+        interval_ms: float = TYPING_THROTTLE_MS,
+        expiry: float = TYPING_EXPIRY_SECONDS,
+    ):
+        # forward(sender_id, sender_username, recipient_id, is_typing) delivers one state change
+        self.forward = forward
+        self.interval = interval_ms / 1000
+        self.expiry = expiry
+        self._states: Dict[Tuple[int, int], _TypingState] = {}
+        self.received = 0
+        self.forwarded = 0
+        self.expired = 0
+
+    def update(self, sender_id: int, sender_username: str, recipient_id: int, is_typing: bool):
+        """Record a typing event from the client"""
+        self.received += 1
+        key = (sender_id, recipient_id)
+        state = self._states.get(key)
+        if state is None:
+            if not is_typing:
+                return
+            state = self._states[key] = _TypingState(sender_username)
+
+        loop = asyncio.get_running_loop()
+        if is_typing:
+            # Every typing event pushes the expiry back
+            if state.expiry_timer is not None:
+                state.expiry_timer.cancel()
+            state.expiry_timer = loop.call_later(self.expiry, self._expire, key)
+
+        if state.flush_timer is not None:
+            # A change is already scheduled; it will carry the latest state
+            state.pending = is_typing
+            return
+        if is_typing == state.forwarded:
+            return
+
+        wait = state.forwarded_at + self.interval - loop.time()
+        if wait <= 0:
+            self._forward(key, state, is_typing)
+        else:
+            state.pending = is_typing
+            state.flush_timer = loop.call_later(wait, self._flush, key)
+
+    def clear_sender(self, sender_id: int):
+        """Stop every typing state of a sender, e.g. when their last socket closes"""
+        for key in [key for key in self._states if key[0] == sender_id]:
+            state = self._states[key]
+            if state.forwarded:
+                try:
+                    self.forward(sender_id, state.username, key[1], False)
+                except Exception as e:
+                    print(f"Error forwarding typing indicator: {e}")
+            self._drop(key, state)
+
+    def _flush(self, key: Tuple[int, int]):
+        state = self._states.get(key)
+        if state is None:
+            return
+        state.flush_timer = None
+        is_typing, state.pending = state.pending, None
+        if is_typing is not None and is_typing != state.forwarded:
+            self._forward(key, state, is_typing)
+        elif not state.forwarded:
+            self._drop(key, state)
+
+    def _expire(self, key: Tuple[int, int]):
+        state = self._states.get(key)
+        if state is None:
+            return
+        state.expiry_timer = None
+        self.expired += 1
+        if state.forwarded:
+            self._forward(key, state, False)
+        else:
+            self._drop(key, state)
+
+    def _forward(self, key: Tuple[int, int], state: _TypingState, is_typing: bool):
+        state.forwarded = is_typing
+        state.forwarded_at = asyncio.get_running_loop().time()
+        self.forwarded += 1
+        try:
+            self.forward(key[0], state.username, key[1], is_typing)
+        except Exception as e:
+            print(f"Error forwarding typing indicator: {e}")
+        if not is_typing:
+            # Forget the pair once the interval is over, unless the sender starts typing again
+            if state.expiry_timer is not None:
+                state.expiry_timer.cancel()
+                state.expiry_timer = None
+            state.flush_timer = asyncio.get_running_loop().call_later(self.interval, self._flush, key)
+
+    def _drop(self, key: Tuple[int, int], state: _TypingState):
+        self._cancel_timers(state)
+        self._states.pop(key, None)
+
+    @staticmethod
+    def _cancel_timers(state: _TypingState):
+        for timer in (state.flush_timer, state.expiry_timer):
+            if timer is not None:
+                timer.cancel()
+        state.flush_timer = None
+        state.expiry_timer = None
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._states),
+            "received": self.received,
+            "forwarded": self.forwarded,
+            "expired": self.expired,
+        }